@@ -1,12 +1,150 @@
 import os
+import time
+import atexit
 import asyncio
+import logging
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from string import Formatter
 import discord
 from discord.ext import commands
+from discord.http import Route
 from cogs.utils.dataIO import dataIO
 from .utils import checks
 from discord.utils import find
 from cogs.utils.chat_formatting import box, pagify
 
+log = logging.getLogger('red.AutoRooms')
+
+# seconds to wait for more changes before writing settings to disk
+FLUSH_DELAY = 5
+# upper bound on pre-created rooms per autoroom
+MAX_POOL_SIZE = 10
+# seconds between background reconciliation passes
+SWEEP_INTERVAL = 300
+# seconds an unused room is left alone before it is considered orphaned
+ORPHAN_GRACE = 120
+# the sweeper deletes at most this many rooms per server per pass, and
+# waits between servers it deleted from, so that a lot of rooms left behind
+# doesn't hold up that server's voice events or run into the rate limit
+SWEEP_DELETE_BATCH = 5
+SWEEP_DELETE_DELAY = 1
+
+
+class LatencyStats:
+    """
+    keeps the most recent timings of each stage of event handling, per
+    server, for working out where the time goes
+    """
+
+    def __init__(self, samples=500):
+        self.samples = samples
+        self.timings = {}  # server id -> stage -> deque of ms
+        self.events = {}  # server id -> events handled
+
+    def count(self, server_id):
+        self.events[server_id] = self.events.get(server_id, 0) + 1
+
+    def record(self, server_id, stage, ms):
+        stages = self.timings.setdefault(server_id, {})
+        if stage not in stages:
+            stages[stage] = deque(maxlen=self.samples)
+        stages[stage].append(ms)
+
+    @contextmanager
+    def time(self, server_id, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(server_id, stage,
+                        (time.perf_counter() - start) * 1000)
+
+    @staticmethod
+    def _percentile(ordered, pct):
+        return ordered[min(len(ordered) - 1,
+                           int(round(pct / 100 * (len(ordered) - 1))))]
+
+    def summary(self, server_id):
+        output = "Server {}: {} events".format(server_id,
+                                               self.events.get(server_id, 0))
+        for stage, samples in sorted(self.timings.get(server_id, {}).items()):
+            ordered = sorted(samples)
+            output += "\n  {:<12} n={:<4} p50 {:.1f}ms p95 {:.1f}ms " \
+                "p99 {:.1f}ms".format(stage, len(ordered),
+                                      self._percentile(ordered, 50),
+                                      self._percentile(ordered, 95),
+                                      self._percentile(ordered, 99))
+        return output
+
+
+class TemplateError(Exception):
+    pass
+
+
+class NameTemplate:
+    """
+    a room name template, compiled once and rendered for every room made
+
+    available fields:
+    {prepend} the server's prepend value
+    {channel} the name of the autoroom
+    {game} the game the joining member is playing
+    {name} the joining member's display name
+    {discrim} the joining member's discriminator
+    {counter} the lowest room number not in use for this autoroom
+    """
+
+    FIELDS = ('prepend', 'channel', 'game', 'name', 'discrim', 'counter')
+
+    def __init__(self, template: str):
+        self.template = template
+        self.fields = set()
+        try:
+            parsed = list(Formatter().parse(template))
+        except ValueError as e:
+            raise TemplateError(str(e))
+        for _, field, spec, conversion in parsed:
+            if field is None:
+                continue
+            if field not in self.FIELDS or spec or conversion:
+                raise TemplateError("Unsupported field {{{}}}".format(field))
+            self.fields.add(field)
+
+    @classmethod
+    def from_settings(cls, chan_settings):
+        """the template equivalent to the pre-template naming options"""
+        template = chan_settings.get('template')
+        if template is None:
+            template = "{game}" if chan_settings.get('gameroom') \
+                else "{prepend} {channel}"
+            if chan_settings.get('atype') == "author":
+                template += " {name}"
+            elif chan_settings.get('atype') == "descrim":
+                template += " {discrim}"
+        return cls(template)
+
+    def render(self, prepend, source, member=None, counter=None):
+        values = dict.fromkeys(self.fields, "")
+        if 'prepend' in values:
+            values['prepend'] = prepend
+        if 'channel' in values:
+            values['channel'] = source.name
+        if 'game' in values:
+            values['game'] = "???"
+            if member is not None and member.game is not None:
+                values['game'] = member.game.name
+        if member is not None:
+            if 'name' in values:
+                values['name'] = member.display_name
+            if 'discrim' in values:
+                values['discrim'] = member.discriminator
+        if 'counter' in values and counter is not None:
+            values['counter'] = counter
+        name = " ".join(self.template.format(**values).split())
+        return name[:100] or source.name
+
 
 class AutoRooms:
     """
@@ -18,6 +156,95 @@ class AutoRooms:
     def __init__(self, bot):
         self.bot = bot
         self.settings = dataIO.load_json('data/autorooms/settings.json')
+        self._dirty = set()
+        self._flush_handle = None
+        self._pending_since = None
+        self.store_stats = {'requested': 0,
+                            'flushes': 0,
+                            'last_flush_ms': 0.0,
+                            'max_flush_ms': 0.0,
+                            'max_delay_ms': 0.0}
+        # in memory indexes, the lists in settings are only for persistence
+        self.index = {}  # server id -> {'channels', 'clones', 'cache'}
+        self.sources = {}  # clone id -> source channel id
+        self.pools = {}  # source channel id -> [pre-created clone ids]
+        self.pooled = set()
+        self._refills = {}  # source channel id -> refill task
+        self._events = {}  # server id -> deque of pending voice events
+        self._consumers = {}  # server id -> task working through events
+        self._open_rooms = {}  # source id -> [room being filled, seats]
+        self._arriving = {}  # room id -> ids of members being moved in
+        self._templates = {}  # source id -> NameTemplate
+        self._numbers = {}  # room id -> (source id, room number)
+        self.latency = LatencyStats()
+        self.sweep_stats = {'passes': 0, 'last_fixed': 0, 'total_fixed': 0}
+        for server_id in self.settings:
+            self._build_index(server_id)
+        atexit.register(self.flush)
+        self._warmup = self.bot.loop.create_task(self._warm_pools())
+        self._sweeper = self.bot.loop.create_task(self._sweep_loop())
+
+    def __unload(self):
+        self._warmup.cancel()
+        self._sweeper.cancel()
+        for task in self._refills.values():
+            task.cancel()
+        for task in self._consumers.values():
+            task.cancel()
+        atexit.unregister(self.flush)
+        self.flush()
+
+    def _build_index(self, server_id):
+        data = self.settings[server_id]
+        idx = {key: set(data.get(key, []))
+               for key in ('channels', 'clones', 'cache')}
+        self.index[server_id] = idx
+        for clone, source in data.get('clonesources', {}).items():
+            if clone in idx['clones']:
+                self.sources[clone] = source
+        for clone, number in data.get('clonenumbers', {}).items():
+            if clone in self.sources:
+                self._numbers[clone] = (self.sources[clone], number)
+        for source, pool in data.get('pools', {}).items():
+            pool = [c for c in pool if c in idx['clones']]
+            self.pools[source] = pool
+            self.pooled.update(pool)
+        return idx
+
+    def _sync_lists(self, server_id):
+        """writes the in memory indexes back to the persisted lists"""
+        data = self.settings.get(server_id)
+        idx = self.index.get(server_id)
+        if data is None or idx is None:
+            return
+        for key in ('channels', 'clones', 'cache'):
+            data[key] = sorted(idx[key])
+        data['clonesources'] = {c: self.sources[c] for c in idx['clones']
+                                if c in self.sources}
+        data['clonenumbers'] = {c: self._numbers[c][1] for c in idx['clones']
+                                if c in self._numbers}
+        data['pools'] = {source: list(self.pools.get(source, []))
+                         for source in idx['channels']
+                         if self.pools.get(source)}
+
+    def forget_clone(self, server_id, channel_id):
+        idx = self.index[server_id]
+        idx['clones'].discard(channel_id)
+        idx['cache'].discard(channel_id)
+        source = self.sources.pop(channel_id, None)
+        self._unpool(source, channel_id)
+        self._arriving.pop(channel_id, None)
+        self._numbers.pop(channel_id, None)
+        if self._open_rooms.get(source, [None])[0] == channel_id:
+            self._open_rooms.pop(source, None)
+        self.save_json(server_id)
+
+    def _unpool(self, source_id, channel_id):
+        if channel_id in self.pooled:
+            self.pooled.discard(channel_id)
+            pool = self.pools.get(source_id, [])
+            if channel_id in pool:
+                pool.remove(channel_id)
 
     @commands.group(name="autoroomset", pass_context=True, no_pm=True)
     async def autoroomset(self, ctx):
@@ -27,6 +254,7 @@ class AutoRooms:
 
     def initial_config(self, server_id):
         """makes an entry for the server, defaults to turned off"""
+        changed = False
 
         if server_id not in self.settings:
             self.settings[server_id] = {'toggleactive': False,
@@ -35,20 +263,27 @@ class AutoRooms:
                                         'clones': [],
                                         'cache': []
                                         }
+            changed = True
+        if server_id not in self.index:
+            self._build_index(server_id)
         # backwards compatability for installs prior to 3.3
         if 'chansettings' not in self.settings[server_id]:
             self.settings[server_id]['chansettings'] = {}
-        for channel in self.settings[server_id]['channels']:
+            changed = True
+        for channel in self.index[server_id]['channels']:
             if channel not in self.settings[server_id]['chansettings']:
                 self.settings[server_id]['chansettings'][channel] = \
                     {'gameroom': False,
                      'atype': None,  # None, "descrim", "author"
                      'ownership': None,  # None for default, T/F overrides
                      }
+                changed = True
         if 'prepend' not in self.settings[server_id]:
             self.settings[server_id]['prepend'] = "Auto:"
+            changed = True
 
-        self.save_json()
+        if changed:
+            self.save_json(server_id)
 
     @checks.admin_or_permissions(Manage_channels=True)
     @autoroomset.command(name="setprepend", pass_context=True, no_pm=True)
@@ -65,7 +300,7 @@ class AutoRooms:
 
         self.initial_config(server.id)
         self.settings[server.id]['prepend'] = prepend[:8]
-        self.save_json()
+        self.save_json(server.id)
         await self.bot.say("Prepend set.")
 
     @checks.admin_or_permissions(Manage_channels=True)
@@ -86,8 +321,11 @@ class AutoRooms:
             if channel is None:
                 return await self.bot.say("That doesn't appear "
                                           "to be a valid channel ID")
-        if channel.id not in self.settings[server.id]['channels']:
+        if channel.id not in self.index[server.id]['channels']:
             return await self.bot.say("That isn't an autoroom")
+        chan_settings = self.settings[server.id]['chansettings'][channel.id]
+        naming = {'gameroom': chan_settings.get('gameroom'),
+                  'atype': chan_settings.get('atype')}
 
         await self.bot.say("Game rooms require the user joining to be playing "
                            "a game, but get a base name of the game discord "
@@ -154,8 +392,108 @@ class AutoRooms:
             self.settings[server.id]['chansettings'][channel.id]['ownership'] \
                 = None
 
-        self.save_json()
+        replaced = None
+        if naming['gameroom'] != chan_settings.get('gameroom') or \
+                naming['atype'] != chan_settings.get('atype'):
+            # the naming answers changed, so the template follows them
+            old = chan_settings.pop('template', None)
+            template = NameTemplate.from_settings(chan_settings)
+            chan_settings['template'] = template.template
+            self._templates[channel.id] = template
+            if old is not None and \
+                    old != NameTemplate.from_settings(naming).template:
+                replaced = old
+        self.save_json(server.id)
         await self.bot.say("Channel specific settings have been updated")
+        if replaced is not None:
+            await self.bot.say("The custom name template `{}` was replaced "
+                               "with `{}`, use nametemplate to set it again"
+                               "".format(replaced,
+                                         self._templates[channel.id].template))
+
+    @checks.admin_or_permissions(Manage_channels=True)
+    @autoroomset.command(name="nametemplate", pass_context=True, no_pm=True)
+    async def setnametemplate(self, ctx, chan: str, *, template: str=None):
+        """
+        sets how rooms made from an autoroom are named
+        Calling without a template goes back to the naming set up with
+        channelsettings
+
+        available fields:
+        {prepend} the server's prepend value
+        {channel} the name of the autoroom
+        {game} the game the room creator is playing
+        {name} the room creator's display name
+        {discrim} the room creator's discriminator
+        {counter} the lowest room number not in use for this autoroom
+
+        example: [p]autoroomset nametemplate 1234567890 {channel} #{counter}
+        """
+        server = ctx.message.server
+        self.initial_config(server.id)
+        if chan not in self.index[server.id]['channels']:
+            return await self.bot.say("That isn't an autoroom")
+
+        chan_settings = self.settings[server.id]['chansettings'][chan]
+        if template is None:
+            chan_settings.pop('template', None)
+        else:
+            try:
+                NameTemplate(template)
+            except TemplateError as e:
+                return await self.bot.say("{}".format(e))
+            chan_settings['template'] = template
+        self._templates[chan] = NameTemplate.from_settings(chan_settings)
+        self.save_json(server.id)
+        await self.bot.say("Room name template set to: `{}`".format(
+            self._templates[chan].template))
+
+    @checks.admin_or_permissions(Manage_channels=True)
+    @autoroomset.command(name="pool", pass_context=True, no_pm=True)
+    async def setpool(self, ctx, chan: str, size: int, rate: int=2):
+        """
+        keeps a number of rooms for an autoroom created ahead of time
+        so people joining it can be moved immediately
+        size is how many rooms to keep ready (0 to disable, max 10)
+        rate is the number of seconds to wait between creating rooms
+        when refilling the pool
+        """
+        server = ctx.message.server
+        self.initial_config(server.id)
+        source = server.get_channel(chan)
+        if source is None or chan not in self.index[server.id]['channels']:
+            return await self.bot.say("That isn't an autoroom")
+        if not 0 <= size <= MAX_POOL_SIZE:
+            return await self.bot.say("Pool size should be between 0 and "
+                                      "{}".format(MAX_POOL_SIZE))
+
+        chan_settings = self.settings[server.id]['chansettings'][chan]
+        chan_settings['poolsize'] = size
+        chan_settings['poolrate'] = max(rate, 1)
+        self.save_json(server.id)
+        await self._drain_pool(server, chan, keep=size)
+        self._schedule_refill(server, source)
+        await self.bot.say("Pool settings updated.")
+
+    @checks.admin_or_permissions(Manage_channels=True)
+    @autoroomset.command(name="togglegrouping", pass_context=True, no_pm=True)
+    async def togglegrouping(self, ctx, chan: str):
+        """
+        toggles grouping people joining an autoroom into shared rooms
+        instead of giving everyone their own room.
+        Rooms are filled up to the user limit of the autoroom, so this
+        does nothing for autorooms without a user limit.
+        """
+        server = ctx.message.server
+        self.initial_config(server.id)
+        if chan not in self.index[server.id]['channels']:
+            return await self.bot.say("That isn't an autoroom")
+
+        chan_settings = self.settings[server.id]['chansettings'][chan]
+        chan_settings['grouping'] = not chan_settings.get('grouping', False)
+        self._open_rooms.pop(chan, None)
+        self.save_json(server.id)
+        await self.bot.say("Grouping: {}".format(chan_settings['grouping']))
 
     @checks.admin_or_permissions(Manage_channels=True)
     @autoroomset.command(name="toggleactive", pass_context=True, no_pm=True)
@@ -169,11 +507,11 @@ class AutoRooms:
 
         if self.settings[server.id]['toggleactive'] is True:
             self.settings[server.id]['toggleactive'] = False
-            self.save_json()
+            self.save_json(server.id)
             await self.bot.say('Auto Rooms disabled.')
         else:
             self.settings[server.id]['toggleactive'] = True
-            self.save_json()
+            self.save_json(server.id)
             await self.bot.say('Auto Rooms enabled.')
 
     @checks.admin_or_permissions(Manage_channels=True)
@@ -183,14 +521,14 @@ class AutoRooms:
         server = ctx.message.server
         if server.id not in self.settings:
             self.initial_config(server.id)
-        if chan in self.settings[server.id]['channels']:
+        if chan in self.index[server.id]['channels']:
             return await self.bot.say("Channel already set.")
         if chan is not None:
             channel = find(lambda m: m.id == chan, server.channels)
             if channel is not None:
                 if channel.type == discord.ChannelType.voice:
-                    self.settings[server.id]['channels'].append(chan)
-                    self.save_json()
+                    self.index[server.id]['channels'].add(chan)
+                    self.save_json(server.id)
                     await self.bot.say('Channel set.')
                 else:
                     await self.bot.say("That isn't a voice channel.")
@@ -207,9 +545,11 @@ class AutoRooms:
         prefix = ctx.prefix
         if server.id not in self.settings:
             self.initial_config(server.id)
-        if chan in self.settings[server.id]['channels']:
-            self.settings[server.id]['channels'].remove(chan)
-            self.save_json()
+        if chan in self.index[server.id]['channels']:
+            self.index[server.id]['channels'].discard(chan)
+            self._templates.pop(chan, None)
+            self.save_json(server.id)
+            await self._drain_pool(server, chan)
             await self.bot.say('Channel unset.')
         else:
             await self.bot.say("No channel with that ID currently set. "
@@ -224,7 +564,7 @@ class AutoRooms:
         if server.id not in self.settings:
             self.initial_config(server.id)
 
-        channels = self.settings[server.id]['channels']
+        channels = self.index[server.id]['channels']
         if len(channels) == 0:
             return await self.bot.say("No autorooms set for this server")
 
@@ -239,11 +579,134 @@ class AutoRooms:
         for page in pagify(output, delims=["\n", ","]):
             await self.bot.send_message(ctx.message.author, box(page))
         for c in fix_list:
-            channels.remove(c)
-            self.save_json
+            channels.discard(c)
+            self.save_json(server.id)
+
+    def save_json(self, server_id=None):
+        """
+        marks a server's settings as changed. The write to disk is deferred
+        so that a burst of voice events results in a single write.
+        """
+        self._dirty.add(server_id)
+        self.store_stats['requested'] += 1
+        if self._pending_since is None:
+            self._pending_since = time.perf_counter()
+        if self._flush_handle is None:
+            self._flush_handle = self.bot.loop.call_later(FLUSH_DELAY,
+                                                          self.flush)
 
-    def save_json(self):
+    def flush(self):
+        """writes pending settings changes to disk"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._dirty:
+            return
+
+        start = time.perf_counter()
+        for server_id in self._dirty:
+            self._sync_lists(server_id)
         dataIO.save_json("data/autorooms/settings.json", self.settings)
+        end = time.perf_counter()
+
+        flush_ms = (end - start) * 1000
+        for server_id in self._dirty:
+            self.latency.record(server_id, 'save', flush_ms)
+        delay_ms = (end - self._pending_since) * 1000
+        self.store_stats['flushes'] += 1
+        self.store_stats['last_flush_ms'] = flush_ms
+        self.store_stats['max_flush_ms'] = max(
+            flush_ms, self.store_stats['max_flush_ms'])
+        self.store_stats['max_delay_ms'] = max(
+            delay_ms, self.store_stats['max_delay_ms'])
+        self._dirty.clear()
+        self._pending_since = None
+
+    @checks.is_owner()
+    @autoroomset.command(name="benchmark", pass_context=True,
+                         no_pm=True, hidden=True)
+    async def benchmark(self, ctx, chan: str, rooms: int=3):
+        """
+        times making rooms from a voice channel the old way (create, edit,
+        wait, set ownership) against the single request path
+        rooms made for this are deleted afterwards
+        """
+        server = ctx.message.server
+        author = ctx.message.author
+        source = server.get_channel(chan)
+        if source is None or source.type != discord.ChannelType.voice:
+            return await self.bot.say("That isn't a voice channel.")
+        rooms = max(1, min(rooms, 10))
+        name = "{} benchmark".format(source.name)
+
+        async def legacy():
+            channel = await \
+                self.bot.create_channel(server, name, *source.overwrites,
+                                        type=discord.ChannelType.voice)
+            await self.bot.edit_channel(channel, bitrate=source.bitrate,
+                                        user_limit=source.user_limit)
+            await asyncio.sleep(0.5)
+            await self._grant_ownership(channel, author)
+            return channel
+
+        async def single():
+            return await self._request_room(server, source, name, author)
+
+        output = "Per room latency over {} room(s)".format(rooms)
+        made = []
+        try:
+            for label, path in (("Old path", legacy),
+                                ("Single request", single)):
+                timings = []
+                for _ in range(rooms):
+                    start = time.perf_counter()
+                    made.append(await path())
+                    timings.append((time.perf_counter() - start) * 1000)
+                output += "\n{}: avg {:.0f}ms, min {:.0f}ms, max {:.0f}ms" \
+                    "".format(label, sum(timings) / len(timings),
+                              min(timings), max(timings))
+        finally:
+            for channel in made:
+                try:
+                    await self.bot.delete_channel(channel)
+                except discord.HTTPException:
+                    pass
+        await self.bot.say(box(output))
+
+    @checks.is_owner()
+    @autoroomset.command(name="timings", pass_context=True, hidden=True)
+    async def timings(self, ctx, server_id: str=None):
+        """
+        shows p50/p95/p99 timings of each stage of handling voice events
+        for every server, or just the one given
+        """
+        if server_id is not None:
+            server_ids = [server_id]
+        else:
+            server_ids = sorted(self.latency.events,
+                                key=lambda s: self.latency.events[s],
+                                reverse=True)
+        if not server_ids:
+            return await self.bot.say("No voice events handled yet.")
+        output = "\n".join(self.latency.summary(s) for s in server_ids)
+        for page in pagify(output, delims=["\nServer", "\n"]):
+            await self.bot.say(box(page))
+
+    @checks.is_owner()
+    @autoroomset.command(name="storestats", pass_context=True, hidden=True)
+    async def storestats(self, ctx):
+        """shows how settings writes are being coalesced"""
+        stats = self.store_stats
+        output = ("Pending servers: {}\n"
+                  "Save requests: {}\n"
+                  "Writes to disk: {}\n"
+                  "Last write: {:.2f}ms\n"
+                  "Slowest write: {:.2f}ms\n"
+                  "Longest time pending: {:.2f}ms"
+                  "").format(len(self._dirty), stats['requested'],
+                             stats['flushes'], stats['last_flush_ms'],
+                             stats['max_flush_ms'], stats['max_delay_ms'])
+        await self.bot.say(box(output))
 
     @checks.admin_or_permissions(Manage_channels=True)
     @autoroomset.command(name="toggleowner", pass_context=True, no_pm=True)
@@ -261,12 +724,12 @@ class AutoRooms:
 
         if self.settings[server.id]['toggleowner'] is True:
             self.settings[server.id]['toggleowner'] = False
-            self.save_json()
+            self.save_json(server.id)
             await self.bot.say('Users no longer own the autorooms '
                                ' they make.')
         else:
             self.settings[server.id]['toggleowner'] = True
-            self.save_json()
+            self.save_json(server.id)
             await self.bot.say('Users now own the autorooms they make.')
 
     @checks.admin_or_permissions(Manage_channels=True)
@@ -311,105 +774,417 @@ class AutoRooms:
         if server.id not in self.settings:
             return
 
-        clones = self.settings[server.id]['clones']
-        del_list = []
-        for c in clones:
-            channel = find(lambda m: m.id == c, server.channels)
+        for c in list(self.index[server.id]['clones']):
+            channel = server.get_channel(c)
             if channel is None:
-                del_list.append(c)
-            else:
-                if len(channel.voice_members) == 0 or delete_all:
+                self.forget_clone(server.id, c)
+            elif c in self.pooled and not delete_all:
+                continue
+            elif len(channel.voice_members) == 0 or delete_all:
+                await self.bot.delete_channel(channel)
+                self.forget_clone(server.id, c)
+
+    def _template(self, server, source_id):
+        template = self._templates.get(source_id)
+        if template is None:
+            chan_settings = self.settings[server.id]['chansettings'][source_id]
+            try:
+                template = NameTemplate.from_settings(chan_settings)
+            except TemplateError:
+                template = NameTemplate("{prepend} {channel}")
+            self._templates[source_id] = template
+        return template
+
+    def _room_name(self, server, source, member=None, room_id=None):
+        """name for a room cloned from source, member is the creator"""
+        number = self._numbers.get(room_id, (None, None))[1]
+        return self._template(server, source.id).render(
+            self.settings[server.id]['prepend'], source, member, number)
+
+    def _claim_number(self, source_id):
+        in_use = {n for s, n in self._numbers.values() if s == source_id}
+        number = 1
+        while number in in_use:
+            number += 1
+        return number
+
+    def _ownership(self, server, source):
+        ownership = \
+            self.settings[server.id]['chansettings'][source.id]['ownership']
+        if ownership is None:
+            ownership = self.settings[server.id].get('toggleowner', False)
+        return ownership
+
+    def _overwrite_payload(self, source, owner=None):
+        """
+        source's permission overwrites in the form the API takes them,
+        with the room ownership overwrite for owner folded in
+        """
+        payload = []
+        owner_overwrite = None
+        if owner is not None:
+            owner_overwrite = discord.PermissionOverwrite(
+                manage_channels=True, manage_roles=True)
+        for target, overwrite in source.overwrites:
+            if owner_overwrite is not None and target.id == owner.id:
+                merged = discord.PermissionOverwrite(**dict(overwrite))
+                merged.update(manage_channels=True, manage_roles=True)
+                owner_overwrite, overwrite = None, merged
+            allow, deny = overwrite.pair()
+            payload.append({'id': target.id,
+                            'allow': allow.value,
+                            'deny': deny.value,
+                            'type': 'role'
+                            if isinstance(target, discord.Role)
+                            else 'member'})
+        if owner_overwrite is not None:
+            allow, deny = owner_overwrite.pair()
+            payload.append({'id': owner.id,
+                            'allow': allow.value,
+                            'deny': deny.value,
+                            'type': 'member'})
+        return payload
+
+    async def _request_room(self, server, source, name, owner=None):
+        """
+        creates a clone of source with its bitrate, user limit and
+        permissions (including ownership) set in a single API request
+        """
+        payload = {'name': name,
+                   'type': discord.ChannelType.voice.value,
+                   'bitrate': source.bitrate,
+                   'user_limit': source.user_limit,
+                   'permission_overwrites':
+                       self._overwrite_payload(source, owner)}
+        route = Route('POST', '/guilds/{guild_id}/channels',
+                      guild_id=server.id)
+        data = await self.bot.http.request(route, json=payload)
+        return discord.Channel(server=server, **data)
+
+    async def _create_room(self, server, source, member=None, owner=None):
+        """creates a clone of source and starts tracking it"""
+        number = None
+        template = self._template(server, source.id)
+        if 'counter' in template.fields:
+            number = self._claim_number(source.id)
+        name = template.render(self.settings[server.id]['prepend'], source,
+                               member, number)
+        with self.latency.time(server.id, 'create'):
+            channel = await self._request_room(server, source, name, owner)
+        if number is not None:
+            self._numbers[channel.id] = (source.id, number)
+        self.index[server.id]['clones'].add(channel.id)
+        self.sources[channel.id] = source.id
+        # written straight away, a clone missing from settings after a
+        # crash is one the sweeper can never find
+        self.save_json(server.id)
+        self.flush()
+        return channel
+
+    async def _grant_ownership(self, channel, member):
+        overwrite = discord.PermissionOverwrite()
+        overwrite.manage_channels = True
+        overwrite.manage_roles = True
+        with self.latency.time(channel.server.id, 'permissions'):
+            await self.bot.edit_channel_permissions(channel, member,
+                                                    overwrite)
+
+    def _take_pooled(self, server, source):
+        """pops a live pre-created room for source if there is one"""
+        pool = self.pools.get(source.id, [])
+        while pool:
+            channel_id = pool.pop(0)
+            self.pooled.discard(channel_id)
+            self.save_json(server.id)
+            channel = server.get_channel(channel_id)
+            if channel is not None:
+                return channel
+            self.forget_clone(server.id, channel_id)
+        return None
+
+    async def _finish_handoff(self, channel, source, member):
+        """the parts of setting up a pooled room that can happen after the
+        member has already been moved in"""
+        server = channel.server
+        try:
+            name = self._room_name(server, source, member, channel.id)
+            if name != channel.name:
+                await self.bot.edit_channel(channel, name=name)
+            if self._ownership(server, source):
+                await self._grant_ownership(channel, member)
+        except discord.HTTPException:
+            pass
+
+    def _schedule_refill(self, server, source):
+        if source.id not in self.index[server.id]['channels']:
+            return
+        size = self.settings[server.id]['chansettings'].get(
+            source.id, {}).get('poolsize', 0)
+        if len(self.pools.get(source.id, [])) >= size:
+            return
+        task = self._refills.get(source.id)
+        if task is None or task.done():
+            self._refills[source.id] = \
+                self.bot.loop.create_task(self._refill_pool(server, source))
+
+    async def _refill_pool(self, server, source):
+        chan_settings = self.settings[server.id]['chansettings'][source.id]
+        pool = self.pools.setdefault(source.id, [])
+        while len(pool) < chan_settings.get('poolsize', 0):
+            if source.id not in self.index[server.id]['channels']:
+                break
+            try:
+                channel = await self._create_room(server, source)
+            except discord.HTTPException:
+                break
+            pool.append(channel.id)
+            self.pooled.add(channel.id)
+            self.save_json(server.id)
+            await asyncio.sleep(chan_settings.get('poolrate', 2))
+
+    async def _drain_pool(self, server, source_id, keep=0):
+        """deletes pre-created rooms for source beyond keep"""
+        pool = self.pools.get(source_id, [])
+        while len(pool) > keep:
+            channel_id = pool.pop()
+            self.pooled.discard(channel_id)
+            channel = server.get_channel(channel_id)
+            if channel is not None and len(channel.voice_members) > 0:
+                # in use already, let it clean up like any other room
+                self.index[server.id]['cache'].add(channel_id)
+                self.save_json(server.id)
+                continue
+            if channel is not None:
+                try:
                     await self.bot.delete_channel(channel)
-                    del_list.append(c)
+                except discord.HTTPException:
+                    pass
+            self.forget_clone(server.id, channel_id)
 
-        for c in del_list:
-            clones.remove(c)
-            self.save_json
+    async def _warm_pools(self):
+        await self.bot.wait_until_ready()
+        for server_id, data in self.settings.items():
+            server = self.bot.get_server(server_id)
+            if server is None or not data.get('toggleactive', False):
+                continue
+            for source_id, chan_settings in \
+                    data.get('chansettings', {}).items():
+                source = server.get_channel(source_id)
+                if source is None or not chan_settings.get('poolsize', 0):
+                    continue
+                for channel_id in list(self.pools.get(source_id, [])):
+                    if server.get_channel(channel_id) is None:
+                        self.forget_clone(server_id, channel_id)
+                self._schedule_refill(server, source)
 
     async def autorooms(self, memb_before, memb_after):
         """This cog is Self Cleaning"""
+        # events are handled in order, one at a time per server, so bursts
+        # of people joining can't race each other on the room state
+        self._submit(memb_after.server.id, self._handle_voice_event,
+                     memb_before, memb_after)
+
+    def _submit(self, server_id, func, *args):
+        """
+        queues a coroutine function to be run for a server after any work
+        already queued for it, returns a future for its result
+        """
+        future = self.bot.loop.create_future()
+        events = self._events.setdefault(server_id, deque())
+        events.append((func, args, future))
+        consumer = self._consumers.get(server_id)
+        if consumer is None or consumer.done():
+            self._consumers[server_id] = \
+                self.bot.loop.create_task(self._consume_events(server_id))
+        return future
+
+    async def _consume_events(self, server_id):
+        events = self._events[server_id]
+        while events:
+            func, args, future = events.popleft()
+            try:
+                result = await func(*args)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception:
+                log.exception("Error in {}".format(func.__name__))
+                result = None
+            if not future.done():
+                future.set_result(result)
+
+    def _group_room(self, server, source):
+        """the room joiners of source are being grouped into, if it has
+        space left"""
+        chan_settings = self.settings[server.id]['chansettings'][source.id]
+        if not chan_settings.get('grouping', False) or not source.user_limit:
+            return None
+        entry = self._open_rooms.get(source.id)
+        if entry is None:
+            return None
+        channel = server.get_channel(entry[0])
+        if channel is None or \
+                max(entry[1], len(channel.voice_members)) >= source.user_limit:
+            self._open_rooms.pop(source.id, None)
+            return None
+        return channel
+
+    async def _move_in(self, member, channel):
+        self._arriving.setdefault(channel.id, set()).add(member.id)
+        try:
+            with self.latency.time(member.server.id, 'move'):
+                await self.bot.move_member(member, channel)
+        except Exception:
+            self._arriving[channel.id].discard(member.id)
+            raise
+
+    async def _handle_voice_event(self, memb_before, memb_after):
         server = memb_after.server
         b_server = memb_before.server
+        start = time.perf_counter()
+        self.latency.count(server.id)
 
-        self.initial_config(server.id)
-        channels = self.settings[server.id]['channels']
-        cache = self.settings[server.id]['cache']
-        clones = self.settings[server.id]['clones']
-        chan_settings = self.settings[server.id]['chansettings']
+        with self.latency.time(server.id, 'config'):
+            self.initial_config(server.id)
+            channels = self.index[server.id]['channels']
+            cache = self.index[server.id]['cache']
+            clones = self.index[server.id]['clones']
         if self.settings[server.id]['toggleactive']:
             if memb_after.voice.voice_channel is not None:
                 chan = memb_after.voice.voice_channel
                 if chan.id in channels:
-                    overwrites = chan.overwrites
-                    bit_rate = chan.bitrate
-                    u_limit = chan.user_limit
-                    prepend = self.settings[server.id]['prepend']
-                    if chan_settings[chan.id]['gameroom']:
-                        if memb_after.game is not None:
-                            cname = memb_after.game.name
-                        else:
-                            cname = "???"
+                    channel = self._group_room(server, chan)
+                    if channel is not None:
+                        await self._move_in(memb_after, channel)
                     else:
-                        cname = "{} {}".format(prepend, chan.name)
-                    if chan_settings[chan.id]['atype'] is None:
-                        pass
-                    elif chan_settings[chan.id]['atype'] == "author":
-                        cname += " {0.display_name}".format(memb_after)
-                    elif chan_settings[chan.id]['atype'] == "descrim":
-                        cname += " {0.discriminator}".format(memb_after)
-                    channel = await \
-                        self.bot.create_channel(server, cname, *overwrites,
-                                                type=discord.ChannelType.voice)
-                    await self.bot.edit_channel(channel, bitrate=bit_rate,
-                                                user_limit=u_limit)
-                    await self.bot.move_member(memb_after, channel)
-
-                    ownership = chan_settings[chan.id]['ownership']
-                    if ownership is None:
-                        ownership = self.settings[server.id].get('toggleowner',
-                                                                 False)
-                    if ownership:
-                        overwrite = discord.PermissionOverwrite()
-                        overwrite.manage_channels = True
-                        overwrite.manage_roles = True
-                        await asyncio.sleep(0.5)
-                        await self.bot.edit_channel_permissions(channel,
-                                                                memb_after,
-                                                                overwrite)
-                    self.settings[server.id]['clones'].append(channel.id)
-                self.save_json()
+                        channel = self._take_pooled(server, chan)
+                        if channel is not None:
+                            await self._move_in(memb_after, channel)
+                            self.bot.loop.create_task(self._finish_handoff(
+                                channel, chan, memb_after))
+                        else:
+                            owner = memb_after \
+                                if self._ownership(server, chan) else None
+                            channel = await self._create_room(
+                                server, chan, memb_after, owner)
+                            await self._move_in(memb_after, channel)
+                        self._schedule_refill(server, chan)
+                        self._open_rooms[chan.id] = [channel.id, 0]
+                    self._open_rooms[chan.id][1] += 1
 
         if memb_after.voice.voice_channel is not None:
             channel = memb_after.voice.voice_channel
+            self._arriving.get(channel.id, set()).discard(memb_after.id)
             if channel.id in clones:
+                if channel.id in self.pooled:
+                    # someone walked into a pooled room on their own
+                    source_id = self.sources.get(channel.id)
+                    self._unpool(source_id, channel.id)
+                    self.save_json(server.id)
+                    source = server.get_channel(source_id)
+                    if source is not None:
+                        self._schedule_refill(server, source)
                 if channel.id not in cache:
-                    cache.append(channel.id)
-                    self.save_json()
+                    cache.add(channel.id)
+                    self.save_json(server.id)
 
-        if b_server.id in self.settings:
-            b_cache = self.settings[b_server.id]['cache']
+        if b_server.id in self.index:
+            b_cache = self.index[b_server.id]['cache']
             if memb_before.voice.voice_channel is not None:
                 channel = memb_before.voice.voice_channel
                 if channel.id in b_cache:
-                    if len(channel.voice_members) == 0:
-                        await self.bot.delete_channel(channel)
-                        self.settingscleanup(b_server)
-
-    def settingscleanup(self, server):
-        """cleanup of settings"""
-        if server.id in self.settings:
-            clones = self.settings[server.id]['clones']
-            cache = self.settings[server.id]['cache']
-            for channel_id in clones:
-                channel = server.get_channel(channel_id)
-                if channel is None:
-                    clones.remove(channel_id)
-                    self.save_json()
-            for channel_id in cache:
-                if channel_id not in clones:
-                    cache.remove(channel_id)
-                    self.save_json()
+                    if len(channel.voice_members) == 0 \
+                            and not self._arriving.get(channel.id):
+                        with self.latency.time(b_server.id, 'delete'):
+                            await self.bot.delete_channel(channel)
+                        self.forget_clone(b_server.id, channel.id)
+
+        self.latency.record(server.id, 'total',
+                            (time.perf_counter() - start) * 1000)
 
+    async def _reconcile(self, server):
+        """
+        one pass over a server's rooms, fixing up anything the voice
+        events missed. Returns the number of entries fixed.
+        """
+        if server.id not in self.index:
+            return 0
+        idx = self.index[server.id]
+        fixed = 0
+        deleted = 0
+        now = datetime.utcnow()
+
+        for channel_id in list(idx['clones']):
+            channel = server.get_channel(channel_id)
+            if channel is None:
+                self.forget_clone(server.id, channel_id)
+                fixed += 1
+                continue
+            arriving = self._arriving.get(channel_id)
+            if arriving:
+                arriving -= {m.id for m in channel.voice_members}
+            if len(channel.voice_members) > 0 or arriving \
+                    or channel_id in self.pooled \
+                    or deleted >= SWEEP_DELETE_BATCH:
+                continue
+            age = (now - channel.created_at).total_seconds()
+            if channel_id not in idx['cache'] and age < ORPHAN_GRACE:
+                continue
+            try:
+                await self.bot.delete_channel(channel)
+            except discord.NotFound:
+                pass
+            except discord.HTTPException:
+                log.debug("Couldn't delete orphaned room {}, will try "
+                          "again next pass".format(channel_id))
+                break
+            self.forget_clone(server.id, channel_id)
+            fixed += 1
+            deleted += 1
+
+        stale = idx['cache'] - idx['clones']
+        if stale:
+            idx['cache'] -= stale
+            fixed += len(stale)
+            self.save_json(server.id)
+        return fixed
+
+    async def _sweep_loop(self):
+        await self.bot.wait_until_ready()
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            fixed = 0
+            for server_id in list(self.index):
+                server = self.bot.get_server(server_id)
+                if server is None:
+                    continue
+                count = await self._submit(server_id, self._reconcile,
+                                           server) or 0
+                if count:
+                    fixed += count
+                    await asyncio.sleep(SWEEP_DELETE_DELAY)
+            self.sweep_stats['passes'] += 1
+            self.sweep_stats['last_fixed'] = fixed
+            self.sweep_stats['total_fixed'] += fixed
+            if fixed:
+                log.info("Reconciled {} autoroom entries".format(fixed))
+
+    @checks.admin_or_permissions(Manage_channels=True)
+    @autoroomset.command(name="sweep", pass_context=True, no_pm=True)
+    async def sweep(self, ctx):
+        """
+        checks this server's generated rooms against what actually exists
+        now rather than waiting for the next background pass.
+        Empty rooms left behind are deleted.
+        """
+        server = ctx.message.server
+        fixed = await self._submit(server.id, self._reconcile, server) or 0
+        stats = self.sweep_stats
+        await self.bot.say("Fixed {} entries for this server.\n"
+                           "Background passes: {}, entries fixed last pass: "
+                           "{}, in total: {}".format(fixed, stats['passes'],
+                                                     stats['last_fixed'],
+                                                     stats['total_fixed']))
 
 def check_folder():
     f = 'data/autorooms'
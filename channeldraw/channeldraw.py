@@ -1,11 +1,106 @@
 import discord
+import logging
 from .utils import checks
 from discord.ext import commands
 from cogs.utils.dataIO import dataIO
 import os
+import json
 from datetime import datetime as dt
 import random
 import asyncio
+import time
+from functools import partial
+
+log = logging.getLogger('red.ChannelDraw')
+
+HISTORY_DIR = 'data/channeldraw/history'
+# candidate ids of draws in progress, one file per channel
+SESSION_DIR = 'data/channeldraw/sessions'
+SESSION_INDEX = 'data/channeldraw/sessions.json'
+# paused draws untouched for this long (seconds) are thrown away
+SESSION_TTL = 60 * 60 * 24
+# candidates prepared ahead of the one being looked at
+PREFETCH = 3
+# put on the prefetch queue when preparing candidates fails
+PREFETCH_FAILED = object()
+# how candidates are weighted, see draw weighting
+WEIGHTINGS = ('message', 'author', 'count')
+EPOCH = dt(1970, 1, 1)
+
+
+class Entry:
+    """the parts of a message a drawing needs to keep around"""
+
+    __slots__ = ('id', 'author_id', 'timestamp', 'content', 'attachment')
+
+    def __init__(self, id, author_id, timestamp, content, attachment=None):
+        self.id = id
+        self.author_id = author_id
+        self.timestamp = timestamp
+        self.content = content
+        self.attachment = attachment  # (filename, url) or None
+
+    @classmethod
+    def from_message(cls, message):
+        attachment = None
+        if message.attachments:
+            a = message.attachments[0]
+            attachment = (a['filename'], a['url'])
+        return cls(message.id, message.author.id, message.timestamp,
+                   message.content, attachment)
+
+    def to_row(self):
+        """the entry as a list for the on disk history cache"""
+        return [self.id, self.author_id,
+                (self.timestamp - EPOCH).total_seconds(), self.content,
+                self.attachment]
+
+    @classmethod
+    def from_row(cls, row):
+        id, author_id, timestamp, content, attachment = row
+        return cls(id, author_id, dt.utcfromtimestamp(timestamp), content,
+                   tuple(attachment) if attachment else None)
+
+
+class Reservoir:
+    """
+    keeps a uniformly random sample of at most size items from a stream
+    of unknown length. A size of 0 keeps everything
+    """
+
+    def __init__(self, size=0):
+        self.size = size
+        self.items = []
+        self.seen = 0
+
+    def add(self, item):
+        self.seen += 1
+        if self.size <= 0 or len(self.items) < self.size:
+            self.items.append(item)
+        else:
+            i = random.randrange(self.seen)
+            if i < self.size:
+                self.items[i] = item
+
+
+def weighted_order(entries, weighting, rng):
+    """
+    one randomly chosen entry per author, with the authors in weighted
+    random order. Each author gets the key u ** (1 / weight) and sorting
+    on it is the same as drawing authors one at a time without
+    replacement (Efraimidis-Spirakis), so rejecting an entry never needs
+    anything reshuffled
+    """
+    by_author = {}
+    for entry in entries:
+        by_author.setdefault(entry.author_id, []).append(entry.id)
+    keyed = []
+    for author_id in sorted(by_author):
+        ids = by_author[author_id]
+        weight = len(ids) if weighting == 'count' else 1
+        keyed.append((rng.random() ** (1 / weight), rng.choice(ids)))
+    keyed.sort(reverse=True)
+    return [message_id for _, message_id in keyed]
 
 
 class ChannelDraw:
@@ -18,12 +113,124 @@ class ChannelDraw:
         self.bot = bot
         self.users = []
         self.queues = {}
+        # channel id -> (timestamp, id) of the newest message drawn from
+        self.latest = {}
+        # channel id -> {message id: Entry} for candidates already in memory
+        self.entries = {}
         self.settings = dataIO.load_json('data/channeldraw/settings.json')
-        self.utilities = self.bot.get_cog("SinbadUtilities")
+        # channel id -> author, seed, cursor, latest, updated
+        self.sessions = dataIO.load_json(SESSION_INDEX)
+        self.expire_sessions()
 
     def save_json(self):
         dataIO.save_json("data/channeldraw/settings.json", self.settings)
 
+    def save_sessions(self):
+        dataIO.save_json(SESSION_INDEX, self.sessions)
+
+    def _session_path(self, chan_id):
+        return os.path.join(SESSION_DIR, '{}.json'.format(chan_id))
+
+    def _shuffled(self, ids, seed):
+        order = list(ids)
+        random.Random(seed).shuffle(order)
+        return order
+
+    def paused(self, chan_id):
+        """true if the channel has a saved draw nobody is running"""
+        self.expire_sessions()
+        return chan_id in self.sessions and chan_id not in self.queues
+
+    def _write_order(self, path, entries, weighting, seed):
+        """
+        works out a drawing's order and saves what's needed to rebuild it.
+        Blocking, run it in an executor
+        """
+        if weighting == 'message':
+            ids = [e.id for e in entries]
+            order = self._shuffled(ids, seed)
+        else:
+            ids = order = weighted_order(entries, weighting,
+                                         random.Random(seed))
+        dataIO.save_json(path, ids)
+        return order
+
+    def _read_order(self, path, weighting, seed):
+        """
+        rebuilds a saved drawing's order. Blocking, run it in an executor
+        """
+        ids = dataIO.load_json(path)
+        if weighting == 'message':
+            return self._shuffled(ids, seed)
+        return ids
+
+    async def start_session(self, channel, author):
+        """
+        saves the drawing that's about to start so it can be resumed.
+        Only the candidate ids are written, once, the order comes from
+        the seed and how far along it is from the cursor. Weighted
+        orders need the authors, so those are written already ordered
+        """
+        entries = self.queues[channel.id]
+        weighting = self.settings.get('weighting', 'message')
+        seed = random.SystemRandom().randrange(2 ** 32)
+        timestamp, latest_id = self.latest.pop(channel.id)
+        order = await self.bot.loop.run_in_executor(
+            None, partial(self._write_order, self._session_path(channel.id),
+                          entries, weighting, seed))
+        self.sessions[channel.id] = {
+            'author': author.id,
+            'seed': seed,
+            'cursor': 0,
+            'latest': [(timestamp - EPOCH).total_seconds(), latest_id],
+            'updated': time.time(),
+            'weighting': weighting,
+            'wanted': self.settings.get('winners', 1),
+            'winners': []
+        }
+        self.save_sessions()
+        keep = set(order)
+        self.entries[channel.id] = {e.id: e for e in entries if e.id in keep}
+        self.queues[channel.id] = order
+
+    async def load_session(self, chan_id):
+        """
+        rebuilds a saved drawing's order. Candidates come from the
+        history cache when there is one, anything else is fetched when
+        it's reached
+        """
+        session = self.sessions[chan_id]
+        order = await self.bot.loop.run_in_executor(
+            None, self._read_order, self._session_path(chan_id),
+            session.get('weighting', 'message'), session['seed'])
+        wanted = set(order[session['cursor']:])
+        self.entries[chan_id] = await self.bot.loop.run_in_executor(
+            None, self._read_entries, self._history_path(chan_id), wanted)
+        self.queues[chan_id] = order
+
+    def advance_session(self, chan_id, cursor, save=True):
+        session = self.sessions[chan_id]
+        session['cursor'] = cursor
+        session['updated'] = time.time()
+        if save:
+            self.save_sessions()
+
+    def end_session(self, chan_id):
+        self.queues.pop(chan_id, None)
+        self.entries.pop(chan_id, None)
+        if self.sessions.pop(chan_id, None) is not None:
+            self.save_sessions()
+        try:
+            os.remove(self._session_path(chan_id))
+        except FileNotFoundError:
+            pass
+
+    def expire_sessions(self):
+        cutoff = time.time() - SESSION_TTL
+        for chan_id, session in list(self.sessions.items()):
+            if session['updated'] < cutoff and chan_id not in self.queues:
+                self.end_session(chan_id)
+
     @checks.admin_or_permissions(Manage_channels=True)
     @commands.group(pass_context=True, name='draw', no_pm=True)
     async def draw(self, ctx):
@@ -43,15 +250,16 @@ class ChannelDraw:
             return await self.bot.say("Those messages are in seperate rooms")
         if a.channel.id in self.queues:
             return await self.bot.say("That channel has a drawing in progress")
+        if self.paused(a.channel.id):
+            return await self.bot.say("That channel has a paused drawing, "
+                                      "resume or discard it first")
         if a.timestamp == b.timestamp:  # Because QA
             return await self.bot.say("Those message(s) are at the same time")
         if a.timestamp > b.timestamp:
             a, b = b, a  # Because I can't trust people to use things correctly
 
         self.initialize(a.channel.id)
-        await self.mkqueue(a.timestamp, b.timestamp, b.channel)
-        self.queues[a.channel.id].append(a)
-        self.queues[b.channel.id].append(b)
+        await self.mkqueue(a.timestamp, b.timestamp, b.channel, a, b)
         self.users.append(ctx.message.author.id)
         await self.validate(b.channel, ctx.message.author)
 
@@ -77,6 +285,9 @@ class ChannelDraw:
             return await self.bot.say("I can't read the future.")
         if ctx.channel.id in self.queues:
             return await self.bot.say("That channel has a drawing in progress")
+        if self.paused(ctx.message.channel.id):
+            return await self.bot.say("That channel has a paused drawing, "
+                                      "resume or discard it first")
         if ctx.message.author.id in self.users:
             return await self.bot.say("You already have a drawing in progress")
 
@@ -105,6 +316,9 @@ class ChannelDraw:
             return await self.bot.say("You already have a drawing in progress")
         if ctx.message.channel.id in self.queues:
             return await self.bot.say("That channel has a drawing in progress")
+        if self.paused(ctx.message.channel.id):
+            return await self.bot.say("That channel has a paused drawing, "
+                                      "resume or discard it first")
 
         self.initialize(ctx.message.channel.id)
         await self.mkqueue(a, b, ctx.message.channel)
@@ -121,88 +335,400 @@ class ChannelDraw:
             return await self.bot.say("You already have a drawing in progress")
         if ctx.message.channel.id in self.queues:
             return await self.bot.say("That channel has a drawing in progress")
+        if self.paused(ctx.message.channel.id):
+            return await self.bot.say("That channel has a paused drawing, "
+                                      "resume or discard it first")
 
         a = dt.strptime(str(self.settings['latest'][ctx.message.channel.id]),
                         "%Y%m%d%H%M")
         b = ctx.message.timestamp
 
-        await self.mkqueue(a, b, ctx.message.channel)
+        await self.mkqueue_cached(a, b, ctx.message.channel)
         self.users.append(ctx.message.author.id)
         await self.validate(ctx.message.channel, ctx.message.author)
 
+    @draw.command(name="resume", pass_context=True)
+    async def resume(self, ctx):
+        """picks a drawing in this channel back up where it left off"""
+        channel = ctx.message.channel
+        author = ctx.message.author
+        if channel.id in self.queues:
+            return await self.bot.say("That channel has a drawing in progress")
+        if not self.paused(channel.id):
+            return await self.bot.say("There's no drawing to resume here")
+        if author.id in self.users:
+            return await self.bot.say("You already have a drawing in progress")
+
+        await self.load_session(channel.id)
+        self.sessions[channel.id]['author'] = author.id
+        self.users.append(author.id)
+        await self.validate(channel, author, resume=True)
+
+    @draw.command(name="discard", pass_context=True)
+    async def discard(self, ctx):
+        """throws away a paused drawing in this channel"""
+        channel = ctx.message.channel
+        if channel.id in self.queues:
+            return await self.bot.say("That channel has a drawing in progress")
+        if not self.paused(channel.id):
+            return await self.bot.say("There's no paused drawing here")
+        self.end_session(channel.id)
+        await self.bot.say("Drawing discarded")
+
+    @draw.command(name="reservoir", pass_context=True)
+    async def set_reservoir(self, ctx, size: int):
+        """
+        limits how many candidate messages are kept in memory for a draw
+        Candidates are sampled at random while reading the channel history
+        so every message keeps the same chance of being drawn, but only
+        this many can be offered before the draw runs out.
+        0 keeps every message (the default)
+        """
+        self.settings['reservoir'] = max(size, 0)
+        self.save_json()
+        if size > 0:
+            await self.bot.say("Draws will keep at most {} candidates"
+                               "".format(size))
+        else:
+            await self.bot.say("Draws will keep every message")
+
+    @draw.command(name="winners", pass_context=True)
+    async def set_winners(self, ctx, count: int):
+        """
+        sets how many different people each drawing picks (default 1)
+        Once someone has won, the rest of their messages are skipped
+        """
+        if count < 1:
+            return await self.bot.send_cmd_help(ctx)
+        self.settings['winners'] = count
+        self.save_json()
+        await self.bot.say("Drawings will pick {} winner(s)".format(count))
+
+    @draw.command(name="weighting", pass_context=True)
+    async def set_weighting(self, ctx, mode: str):
+        """
+        sets how entries are weighted
+        message: every message is an entry (the default), so the more
+        someone posts the better their odds
+        author: one random message per person, everyone has equal odds
+        count: one random message per person, odds still go up with how
+        many messages they posted, but only one of them is ever offered
+        """
+        mode = mode.lower()
+        if mode not in WEIGHTINGS:
+            return await self.bot.send_cmd_help(ctx)
+        self.settings['weighting'] = mode
+        self.save_json()
+        await self.bot.say("Drawings will be weighted by {}".format(mode))
+
     def initialize(self, chan_id: str):
         if chan_id not in self.settings['latest']:
             self.settings['latest'][chan_id] = 0
             self.save_json()
 
-    async def validate(self, channel, author):
-        if len(self.queues[channel.id]) == 0:
-            self.users.remove(author.id)
-            return await self.bot.send_message(author, "No new messages.")
-        latest = self.queues[channel.id][-1].timestamp.strftime("%Y%m%d%H%M")
-        fail_count = 0
-        random.seed()
-        random.shuffle(self.queues[channel.id])
-
-        while author.id in self.users:
-            if fail_count == 1:
-                await asyncio.sleep(1)
-                await self.bot.send_message(author, "Quit wasting my time.")
-            if fail_count == 2:
-                await asyncio.sleep(1)
-                await self.bot.send_message(author, "Next one either quit "
-                                            "or do it correctly")
-            if fail_count == 3:
-                await asyncio.sleep(1)
-                await self.bot.send_message(author, "We are done here.")
-                self.users.remove(author.id)
-                break
+    async def validate(self, channel, author, resume=False):
+        if not resume:
             if len(self.queues[channel.id]) == 0:
-                await asyncio.sleep(1)
-                await self.bot.send_message(author, "That's all folks")
                 self.users.remove(author.id)
-                break
-            entry = self.queues[channel.id].pop()
-            em = self.qform(entry)
-            await self.bot.send_message(author, embed=em)
-            await asyncio.sleep(1)
-            dm = await self.bot.send_message(author,
-                                             "Is this a valid entry?"
-                                             "(yes/no/quit)")
-
-            message = await self.bot.wait_for_message(
-                                                channel=dm.channel,
-                                                author=author, timeout=60)
-            if message is None:
-                fail_count += 1
-                continue
-            reply = message.clean_content.lower()
-
-            if reply[0] == 'y':
-                await self.bot.send_message(channel,
-                                            "{} won the drawing with "
-                                            "the following entry"
-                                            "".format(entry.author.mention))
-                await self.bot.send_message(channel, embed=em)
-                self.settings['latest'][channel.id] = int(latest) + 1
-                self.users.remove(author.id)
-                self.save_json()
-            if reply[0] == 'n':
-                await self.bot.send_message(author, "Ok then...")
-            if reply[0] == 'q':
-                await self.bot.send_message(author,
-                                            "I guess we're done here")
-                self.users.remove(author.id)
-        self.queues.pop(channel.id, None)
+                self.queues.pop(channel.id, None)
+                self.latest.pop(channel.id, None)
+                return await self.bot.send_message(author, "No new messages.")
+            await self.start_session(channel, author)
+        session = self.sessions[channel.id]
+        latest, latest_id = session['latest']
+        latest = dt.utcfromtimestamp(latest).strftime("%Y%m%d%H%M")
+        winners = session.setdefault('winners', [])
+        wanted = session.get('wanted', 1)
+        fail_count = 0
+        failed = False
+        # the next few embeds get built (and fetched, for resumed drawings)
+        # while the current one is being looked at. Sends aren't spaced out
+        # by hand, discord.py already waits out any rate limit it hits
+        prepared = asyncio.Queue(maxsize=PREFETCH)
+        producer = self.bot.loop.create_task(self.prefetch(channel, prepared))
+
+        try:
+            while author.id in self.users:
+                if fail_count == 1:
+                    await self.bot.send_message(author,
+                                                "Quit wasting my time.")
+                if fail_count == 2:
+                    await self.bot.send_message(author, "Next one either quit "
+                                                "or do it correctly")
+                if fail_count == 3:
+                    await self.bot.send_message(author, "We are done here.")
+                    self.users.remove(author.id)
+                    break
+                item = await prepared.get()
+                if item is PREFETCH_FAILED:
+                    await self.bot.send_message(author, "Something went wrong "
+                                                "getting the next entry, the "
+                                                "drawing is paused. Use "
+                                                "`draw resume` in the channel "
+                                                "to carry on")
+                    self.users.remove(author.id)
+                    failed = True
+                    break
+                if item is None:
+                    await self.bot.send_message(author, "That's all folks")
+                    self.users.remove(author.id)
+                    break
+                position, entry, em = item
+                # prepared before its author won, the next answer saves the
+                # cursor past it
+                if entry.author_id in winners:
+                    self.advance_session(channel.id, position + 1, save=False)
+                    continue
+                dm = await self.bot.send_message(author,
+                                                 "Is this a valid entry?"
+                                                 "(yes/no/quit)", embed=em)
+
+                message = await self.bot.wait_for_message(
+                                                    channel=dm.channel,
+                                                    author=author, timeout=60)
+                # a restart before this point asks about the same entry again
+                self.advance_session(channel.id, position + 1)
+                if message is None:
+                    fail_count += 1
+                    continue
+                reply = message.clean_content.lower()
 
-    async def mkqueue(self, a, b, channel):
+                if reply[0] == 'y':
+                    winners.append(entry.author_id)
+                    if wanted > 1:
+                        announcement = ("<@{}> is winner {} of {} with the "
+                                        "following entry"
+                                        "".format(entry.author_id,
+                                                  len(winners), wanted))
+                    else:
+                        announcement = ("<@{}> won the drawing with the "
+                                        "following entry"
+                                        "".format(entry.author_id))
+                    await self.bot.send_message(channel, announcement,
+                                                embed=em)
+                    self.settings['latest'][channel.id] = int(latest) + 1
+                    self.settings.setdefault('latest_id', {})[channel.id] = \
+                        latest_id
+                    self.save_json()
+                    self.save_sessions()
+                    if len(winners) >= wanted:
+                        self.users.remove(author.id)
+                if reply[0] == 'n':
+                    await self.bot.send_message(author, "Ok then...")
+                if reply[0] == 'q':
+                    await self.bot.send_message(author,
+                                                "I guess we're done here")
+                    self.users.remove(author.id)
+        finally:
+            producer.cancel()
+        if failed:
+            # keep the saved session so it can be resumed
+            self.queues.pop(channel.id, None)
+            self.entries.pop(channel.id, None)
+            return
+        if winners:
+            # nothing up to the newest message drawn from is read again
+            await self.bot.loop.run_in_executor(
+                None, self._trim_history, channel.id, latest_id)
+        self.end_session(channel.id)
+
+    async def prefetch(self, channel, prepared):
+        """
+        puts (position, entry, embed) for each remaining candidate on the
+        queue, then None once there's nothing left, or PREFETCH_FAILED if
+        something broke. Deleted messages and entries from people who
+        have already won are skipped here, the cursor moves past them
+        with the next answer
+        """
+        session = self.sessions[channel.id]
+        winners = session.setdefault('winners', [])
+        order = self.queues[channel.id]
+        entries = self.entries[channel.id]
+        try:
+            for position in range(session['cursor'], len(order)):
+                message_id = order[position]
+                entry = entries.pop(message_id, None)
+                if entry is not None and entry.author_id in winners:
+                    continue
+                if entry is None:
+                    entry = await self.fetch_entry(channel, message_id)
+                if entry is None or entry.author_id in winners:
+                    continue
+                em = self.qform(entry, channel)
+                await prepared.put((position, entry, em))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("Preparing draw candidates for {} failed"
+                          "".format(channel.id))
+            await prepared.put(PREFETCH_FAILED)
+            return
+        await prepared.put(None)
+
+    async def fetch_entry(self, channel, message_id):
+        try:
+            message = await self.bot.get_message(channel, message_id)
+        except discord.HTTPException:
+            return None
+        return Entry.from_message(message)
+
+    async def mkqueue(self, a, b, channel, *extra):
+        """
+        reads the history between a and b (plus any extra messages) into
+        the channel's queue, sampling it down if a reservoir size is set
+        """
+        # the channel counts as having a drawing from here on
         self.queues[channel.id] = []
-        async for message in \
-                self.bot.logs_from(channel, limit=1000000,
-                                   after=a, before=b, reverse=True):
-                self.queues[channel.id].append(message)
+        reservoir = Reservoir(self.settings.get('reservoir', 0))
+        latest = None
+        try:
+            async for message in \
+                    self.bot.logs_from(channel, limit=1000000,
+                                       after=a, before=b, reverse=True):
+                reservoir.add(Entry.from_message(message))
+                latest = (message.timestamp, message.id)
+        except BaseException:
+            self.queues.pop(channel.id, None)
+            raise
+        for message in extra:
+            reservoir.add(Entry.from_message(message))
+            if latest is None or message.timestamp > latest[0]:
+                latest = (message.timestamp, message.id)
+        self.queues[channel.id] = reservoir.items
+        if latest is not None:
+            self.latest[channel.id] = latest
+
+    def _history_path(self, chan_id):
+        return os.path.join(HISTORY_DIR, '{}.jsonl'.format(chan_id))
+
+    def _last_cached_id(self, path):
+        """id of the last entry in a history file, without reading it all"""
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            pos = f.tell()
+            chunk = b''
+            while pos > 0 and chunk.count(b'\n') < 2:
+                step = min(4096, pos)
+                pos -= step
+                f.seek(pos)
+                chunk = f.read(step) + chunk
+        lines = chunk.strip().split(b'\n')
+        if not lines or not lines[-1]:
+            return None
+        try:
+            return json.loads(lines[-1].decode('utf-8'))[0]
+        except ValueError:
+            return None
+
+    async def sync_history(self, channel, after):
+        """
+        appends any messages newer than what's already cached for the
+        channel to its history file, starting from after if there's no
+        cache yet
+        """
+        path = self._history_path(channel.id)
+        last_id = self._last_cached_id(path)
+        start = discord.Object(id=last_id) if last_id is not None else after
+        with open(path, 'a', encoding='utf-8') as f:
+            async for message in \
+                    self.bot.logs_from(channel, limit=1000000,
+                                       after=start, reverse=True):
+                f.write(json.dumps(Entry.from_message(message).to_row()))
+                f.write('\n')
+
+    async def mkqueue_cached(self, a, b, channel):
+        """
+        like mkqueue, but extends the channel's on disk history cache
+        from the last message it has and reads the range from there
+        Messages deleted after being cached can still come up, the person
+        validating the draw should catch those
+        """
+        # the channel counts as having a drawing from here on, so nothing
+        # else appends to its history file at the same time
+        self.queues[channel.id] = []
+        try:
+            await self.sync_history(channel, a)
+            after_id = self.settings.get('latest_id', {}).get(channel.id)
+            items, latest = await self.bot.loop.run_in_executor(
+                None, partial(self._read_range,
+                              self._history_path(channel.id), a, b, after_id,
+                              self.settings.get('reservoir', 0)))
+        except BaseException:
+            self.queues.pop(channel.id, None)
+            raise
+        self.queues[channel.id] = items
+        if latest is not None:
+            self.latest[channel.id] = latest
+
+    def _read_range(self, path, a, b, after_id, size):
+        """
+        samples the cached entries after after_id (or a, without one) and
+        before b, returns them with the (timestamp, id) of the newest.
+        Blocking, run it in an executor
+        """
+        reservoir = Reservoir(size)
+        latest = None
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                entry = Entry.from_row(json.loads(line))
+                if after_id is not None:
+                    if int(entry.id) <= int(after_id):
+                        continue
+                elif entry.timestamp < a:
+                    continue
+                if entry.timestamp >= b:
+                    break
+                reservoir.add(entry)
+                latest = (entry.timestamp, entry.id)
+        return reservoir.items, latest
+
+    def _read_entries(self, path, wanted):
+        """
+        {id: Entry} for the wanted ids found in a history file.
+        Blocking, run it in an executor
+        """
+        entries = {}
+        if not os.path.exists(path):
+            return entries
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                entry = Entry.from_row(json.loads(line))
+                if entry.id in wanted:
+                    entries[entry.id] = entry
+        return entries
+
+    def _trim_history(self, chan_id, after_id):
+        """
+        drops cached entries at or before after_id, they can't come up in
+        a draw again. The last line is always kept so syncing knows where
+        to carry on from. Blocking, run it in an executor
+        """
+        path = self._history_path(chan_id)
+        if not os.path.exists(path):
+            return
+        tmp = path + '.tmp'
+        last = None
+        kept = 0
+        with open(path, encoding='utf-8') as src, \
+                open(tmp, 'w', encoding='utf-8') as dst:
+            for line in src:
+                last = line
+                if int(json.loads(line)[0]) > int(after_id):
+                    dst.write(line)
+                    kept += 1
+            if not kept and last is not None:
+                dst.write(last)
+        os.replace(tmp, path)
 
     async def get_msg(self, message_id: str, server=None):
+        # SinbadUtils knows how to find a message without trying every
+        # channel in turn, fall back to doing that if it isn't loaded
+        utils = self.bot.get_cog('SinbadUtils')
+        if utils is not None:
+            return await utils.locator.locate(message_id, server)
+
         if server is not None:
             for channel in server.channels:
                 try:
@@ -222,24 +748,27 @@ class ChannelDraw:
                 except Exception:
                     pass
 
-    def qform(self, message):
-        channel = message.channel
+    def qform(self, entry, channel):
         server = channel.server
-        content = message.content
-        author = message.author
+        content = entry.content
+        author = server.get_member(entry.author_id)
         sname = server.name
         cname = channel.name
-        avatar = author.avatar_url if author.avatar \
-            else author.default_avatar_url
         footer = 'Said in {} #{}'.format(sname, cname)
-        em = discord.Embed(description=content, color=author.color,
-                           timestamp=message.timestamp)
-        em.set_author(name='{}'.format(author.name), icon_url=avatar)
+        if author is not None:
+            avatar = author.avatar_url if author.avatar \
+                else author.default_avatar_url
+            em = discord.Embed(description=content, color=author.color,
+                               timestamp=entry.timestamp)
+            em.set_author(name='{}'.format(author.name), icon_url=avatar)
+        else:
+            # they've left since, all that's left is the id
+            em = discord.Embed(description=content,
+                               timestamp=entry.timestamp)
+            em.set_author(name='User {}'.format(entry.author_id))
         em.set_footer(text=footer)
-        if message.attachments:
-            a = message.attachments[0]
-            fname = a['filename']
-            url = a['url']
+        if entry.attachment is not None:
+            fname, url = entry.attachment
             if fname.split('.')[-1] in ['png', 'jpg', 'gif', 'jpeg']:
                 em.set_image(url=url)
             else:
@@ -250,15 +779,17 @@ class ChannelDraw:
 
 
 def check_folder():
-    f = 'data/channeldraw'
-    if not os.path.exists(f):
-        os.makedirs(f)
+    for f in (HISTORY_DIR, SESSION_DIR):
+        if not os.path.exists(f):
+            os.makedirs(f)
 
 
 def check_file():
     f = 'data/channeldraw/settings.json'
     if dataIO.is_valid_json(f) is False:
         dataIO.save_json(f, {'latest': {}})
+    if dataIO.is_valid_json(SESSION_INDEX) is False:
+        dataIO.save_json(SESSION_INDEX, {})
 
 
 def setup(bot):
@@ -144,8 +144,9 @@ class MultiQuote:
         """
 
         if self.settings["global"]["csmq"]:
+            messages = await self.get_msgs(args)
             for message_id in args:
-                message = await self.get_msg(str(message_id))
+                message = messages.get(message_id)
                 if message is not None:
                     await self.sendifallowed(ctx.message.author,
                                              ctx.message.channel, message)
@@ -163,9 +164,11 @@ class MultiQuote:
         server = ctx.message.channel.server
         if server.id not in self.settings:
             await self.init_settings(server)
+        # sent in the order asked for, discord.py already waits out any
+        # rate limit the sends run into
+        messages = await self.get_msgs(args, server)
         for message_id in args:
-            message = await self.get_msg(message_id, server)
-            await asyncio.sleep(1)
+            message = messages.get(message_id)
             if message is not None:
                 await self.sendifallowed(ctx.message.author,
                                          ctx.message.channel, message)
@@ -175,6 +178,12 @@ class MultiQuote:
                 await self.bot.send_message(ctx.message.channel, embed=em)
 
     async def get_msg(self, message_id: str, server=None):
+        # SinbadUtils knows how to find a message without trying every
+        # channel in turn, fall back to doing that if it isn't loaded
+        utils = self.bot.get_cog('SinbadUtils')
+        if utils is not None:
+            return await utils.locator.locate(message_id, server)
+
         if server is not None:
             for channel in server.channels:
                 try:
@@ -195,6 +204,20 @@ class MultiQuote:
                     pass
         return None
 
+    async def get_msgs(self, message_ids, server=None):
+        """returns {id: message} for whichever of the ids were found"""
+        utils = self.bot.get_cog('SinbadUtils')
+        if utils is not None:
+            return await utils.locator.locate_many(message_ids, server)
+
+        found = {}
+        for message_id in message_ids:
+            if message_id not in found:
+                message = await self.get_msg(message_id, server)
+                if message is not None:
+                    found[message_id] = message
+        return found
+
     async def sendifallowed(self, who, where, message=None):
         """checks if a response should be sent
         then sends the appropriate response"""
@@ -1,13 +1,225 @@
+import asyncio
 import discord
 from discord.ext import commands
 from cogs.utils import checks
+from cogs.utils.chat_formatting import box
 from discord.utils import snowflake_time
 
+
+class MessageLocator:
+    """
+    finds a message by id without knowing which channel it's in
+
+    The client's message cache is checked first. Failing that, channels
+    that could hold the message are ranked by how likely they are to have
+    it and probed a few at a time, stopping as soon as one has it.
+    """
+
+    def __init__(self, bot, concurrency=5):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.stats = {'lookups': 0,
+                      'cache_hits': 0,
+                      'found': 0,
+                      'not_found': 0,
+                      'requests': 0,
+                      'cancelled': 0}
+
+    def candidates(self, message_id: str, server=None):
+        """
+        text channels that could contain the message, most likely first
+
+        Channels made after the message are left out. The rest go in three
+        tiers by the newest message id known for them: at or past the
+        target, unknown, then older than the target (that id can be out of
+        date, so those are still tried). discord.py 0.16 channels don't
+        keep last_message_id, so the newest message in the client's
+        message cache is used for them instead
+        """
+        target = int(message_id)
+        servers = [server] if server is not None else self.bot.servers
+        newest = {}
+        for message in self.bot.messages:
+            seen = newest.get(message.channel.id)
+            if seen is None or int(message.id) > seen:
+                newest[message.channel.id] = int(message.id)
+        likely, unknown, stale = [], [], []
+        for s in servers:
+            for channel in s.channels:
+                if channel.type != discord.ChannelType.text:
+                    continue
+                # ids are creation times, a channel made after the message
+                # can't contain it
+                if int(channel.id) > target:
+                    continue
+                if not channel.permissions_for(s.me).read_message_history:
+                    continue
+                last_id = getattr(channel, 'last_message_id', None)
+                if last_id is None:
+                    last_id = newest.get(channel.id)
+                if last_id is None:
+                    unknown.append(channel)
+                elif int(last_id) >= target:
+                    likely.append(channel)
+                else:
+                    stale.append(channel)
+        return likely + unknown + stale
+
+    def _cached(self, message_id, server=None):
+        message = discord.utils.get(self.bot.messages, id=message_id)
+        if message is not None and \
+                (server is None or message.server == server):
+            return message
+        return None
+
+    async def _run_workers(self, probe, finished):
+        """
+        runs probe on a few workers until they run out of work or
+        finished() is true, then cancels whichever are still going
+        """
+        workers = [self.bot.loop.create_task(probe())
+                   for _ in range(self.concurrency)]
+        try:
+            pending = set(workers)
+            while pending and not finished():
+                _, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for worker in workers:
+                if not worker.done():
+                    worker.cancel()
+                    self.stats['cancelled'] += 1
+
+    async def locate(self, message_id: str, server=None):
+        """returns the message, or None if it couldn't be found"""
+        self.stats['lookups'] += 1
+        if not message_id.isdigit():
+            self.stats['not_found'] += 1
+            return None
+        message = self._cached(message_id, server)
+        if message is not None:
+            self.stats['cache_hits'] += 1
+            return message
+
+        channels = iter(self.candidates(message_id, server))
+        found = []
+
+        async def probe():
+            for channel in channels:
+                if found:
+                    return
+                self.stats['requests'] += 1
+                try:
+                    message = await self.bot.get_message(channel, message_id)
+                except discord.HTTPException:
+                    continue
+                if message is not None:
+                    found.append(message)
+                    return
+
+        await self._run_workers(probe, lambda: bool(found))
+
+        if found:
+            self.stats['found'] += 1
+            return found[0]
+        self.stats['not_found'] += 1
+        return None
+
+    async def locate_many(self, message_ids, server=None):
+        """
+        finds several messages at once, returns {id: message} for the ones
+        that were found
+
+        Each channel that could hold any of them is read once per cluster
+        of nearby ids, a page of history around one id settles every other
+        outstanding id in that page's range for that channel
+        """
+        ids = set(message_ids)
+        self.stats['lookups'] += len(ids)
+        found = {}
+        for message_id in ids:
+            message = self._cached(message_id, server) \
+                if message_id.isdigit() else None
+            if message is not None:
+                found[message_id] = message
+                self.stats['cache_hits'] += 1
+        outstanding = set(i for i in ids if i.isdigit() and i not in found)
+
+        # channel id -> the outstanding ids it could hold
+        plausible = {}
+        channels = []
+        for message_id in sorted(outstanding, key=int):
+            for channel in self.candidates(message_id, server):
+                if channel.id not in plausible:
+                    plausible[channel.id] = []
+                    channels.append(channel)
+                plausible[channel.id].append(message_id)
+        channels = iter(channels)
+
+        async def probe():
+            for channel in channels:
+                pending = plausible[channel.id]
+                while pending and outstanding:
+                    target = pending.pop(0)
+                    if target not in outstanding:
+                        continue
+                    self.stats['requests'] += 1
+                    window = []
+                    try:
+                        async for message in self.bot.logs_from(
+                                channel, limit=100,
+                                around=discord.Object(id=target)):
+                            window.append(message)
+                    except discord.HTTPException:
+                        break
+                    for message in window:
+                        if message.id in outstanding:
+                            outstanding.discard(message.id)
+                            found[message.id] = message
+                            self.stats['found'] += 1
+                    if not window:
+                        break
+                    # the page is a contiguous slice of the channel, so
+                    # anything else in its range isn't in this channel
+                    low = min(int(m.id) for m in window)
+                    high = max(int(m.id) for m in window)
+                    pending = [i for i in pending
+                               if i in outstanding and
+                               not low <= int(i) <= high]
+                if not outstanding:
+                    return
+
+        if outstanding:
+            await self._run_workers(probe, lambda: not outstanding)
+        self.stats['not_found'] += len(ids) - len(found)
+        return found
+
+
 class SinbadUtils:
     """personal utils"""
 
     def __init__(self, bot):
         self.bot = bot
+        self.locator = MessageLocator(bot)
+
+    @checks.is_owner()
+    @commands.command(pass_context=True, hidden=True)
+    async def locatorstats(self, ctx):
+        """Shows how message lookups by id are doing"""
+        stats = self.locator.stats
+        lookups = stats['lookups'] or 1
+        output = ("Lookups: {}\n"
+                  "From cache: {}\n"
+                  "Found by probing: {}\n"
+                  "Not found: {}\n"
+                  "Hit rate: {:.1%}\n"
+                  "Requests made: {}\n"
+                  "Probes cancelled: {}"
+                  "").format(stats['lookups'], stats['cache_hits'],
+                             stats['found'], stats['not_found'],
+                             (stats['cache_hits'] + stats['found']) / lookups,
+                             stats['requests'], stats['cancelled'])
+        await self.bot.say(box(output))
 
     @checks.is_owner()
     @commands.command(pass_context=True, no_pm=True)
@@ -1,11 +1,79 @@
 import os
+import time
+import heapq
+import atexit
+import logging
+from collections import deque
+from contextlib import contextmanager
 from datetime import date, datetime, timedelta
 import asyncio
 import discord
 from discord.ext import commands
 from cogs.utils.dataIO import dataIO
+from cogs.utils.chat_formatting import box, pagify
 from .utils import checks
 
+log = logging.getLogger('red.TempChannels')
+
+SHARD_DIR = 'data/tempchannels/servers'
+# seconds to wait for more changes before writing a server's settings
+FLUSH_DELAY = 5
+# seconds a temp channel nobody has joined yet is kept around
+GRACE_PERIOD = 300
+# seconds between checking the occupancy counts against the client cache
+RECONCILE_INTERVAL = 600
+# deletions in flight at once during a purge, and seconds between
+# progress updates (message edits have their own rate limit)
+PURGE_CONCURRENCY = 5
+PURGE_PROGRESS_INTERVAL = 3
+
+
+class LatencyStats:
+    """
+    keeps the most recent timings of each stage of event handling, per
+    server, for working out where the time goes
+    """
+
+    def __init__(self, samples=500):
+        self.samples = samples
+        self.timings = {}  # server id -> stage -> deque of ms
+        self.events = {}  # server id -> events handled
+
+    def count(self, server_id):
+        self.events[server_id] = self.events.get(server_id, 0) + 1
+
+    def record(self, server_id, stage, ms):
+        stages = self.timings.setdefault(server_id, {})
+        if stage not in stages:
+            stages[stage] = deque(maxlen=self.samples)
+        stages[stage].append(ms)
+
+    @contextmanager
+    def time(self, server_id, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(server_id, stage,
+                        (time.perf_counter() - start) * 1000)
+
+    @staticmethod
+    def _percentile(ordered, pct):
+        return ordered[min(len(ordered) - 1,
+                           int(round(pct / 100 * (len(ordered) - 1))))]
+
+    def summary(self, server_id):
+        output = "Server {}: {} events".format(server_id,
+                                               self.events.get(server_id, 0))
+        for stage, samples in sorted(self.timings.get(server_id, {}).items()):
+            ordered = sorted(samples)
+            output += "\n  {:<12} n={:<4} p50 {:.1f}ms p95 {:.1f}ms " \
+                "p99 {:.1f}ms".format(stage, len(ordered),
+                                      self._percentile(ordered, 50),
+                                      self._percentile(ordered, 95),
+                                      self._percentile(ordered, 99))
+        return output
+
 
 class TempChannels:
     """
@@ -19,7 +87,158 @@ class TempChannels:
 
     def __init__(self, bot):
         self.bot = bot
-        self.settings = dataIO.load_json('data/tempchannels/settings.json')
+        self.settings = self._load_settings()
+        self.latency = LatencyStats()
+        self._dirty = set()
+        self._flush_handle = None
+        atexit.register(self.flush)
+        # pending deletions, a heap of (loop time, channel id, server id)
+        # entries only count if they match what's armed for that channel
+        self._deadlines = []
+        self._armed = {}  # channel id -> loop time it should be deleted at
+        self._wakeup = asyncio.Event()
+        self.occupancy = {}  # channel id -> members connected
+        self._scheduler = self.bot.loop.create_task(self._deletion_loop())
+        self._reconciler = self.bot.loop.create_task(self._reconcile_loop())
+
+    def __unload(self):
+        self._scheduler.cancel()
+        self._reconciler.cancel()
+        atexit.unregister(self.flush)
+        self.flush()
+
+    def _load_settings(self):
+        """
+        loads each server's settings from its own file, moving over
+        anything still in the old combined settings file
+        """
+        settings = {}
+        for fname in os.listdir(SHARD_DIR):
+            if fname.endswith('.json'):
+                settings[fname[:-5]] = \
+                    dataIO.load_json(os.path.join(SHARD_DIR, fname))
+
+        legacy = dataIO.load_json('data/tempchannels/settings.json')
+        if legacy:
+            for server_id, data in legacy.items():
+                if server_id not in settings:
+                    settings[server_id] = data
+                    dataIO.save_json(self._shard_path(server_id), data)
+            dataIO.save_json('data/tempchannels/settings.json', {})
+        return settings
+
+    @staticmethod
+    def _shard_path(server_id):
+        return os.path.join(SHARD_DIR, '{}.json'.format(server_id))
+
+    def reconcile_occupancy(self, server):
+        """
+        resets the occupancy counts of a server's temp channels from the
+        client cache, and makes sure empty ones have a deletion timer
+        returns the number of counts that had drifted
+        """
+        if server.id not in self.settings:
+            return 0
+        drifted = 0
+        cache = self.settings[server.id]['cache']
+        for channel_id in self.settings[server.id]['channels']:
+            channel = server.get_channel(channel_id)
+            if channel is None:
+                continue
+            count = len(channel.voice_members)
+            if self.occupancy.get(channel_id) != count:
+                drifted += 1
+                self.occupancy[channel_id] = count
+            if count == 0 and channel_id not in self._armed:
+                if channel_id in cache:
+                    self._arm(server.id, channel_id)
+                else:
+                    self._arm_unused(server.id, channel)
+        return drifted
+
+    async def _reconcile_loop(self):
+        await self.bot.wait_until_ready()
+        while True:
+            await asyncio.sleep(RECONCILE_INTERVAL)
+            drifted = 0
+            for server_id in list(self.settings):
+                server = self.bot.get_server(server_id)
+                if server is not None:
+                    drifted += self.reconcile_occupancy(server)
+            if drifted:
+                log.debug("Corrected {} temp channel occupancy counts"
+                          "".format(drifted))
+
+    def _arm(self, server_id, channel_id, delay=0):
+        """schedules a channel for deletion, replacing any earlier timer"""
+        when = self.bot.loop.time() + max(delay, 0)
+        self._armed[channel_id] = when
+        heapq.heappush(self._deadlines, (when, channel_id, server_id))
+        if self._deadlines[0][1] == channel_id:
+            self._wakeup.set()
+
+    def _disarm(self, channel_id):
+        self._armed.pop(channel_id, None)
+
+    def _arm_unused(self, server_id, channel):
+        """schedules a channel nobody has joined for the end of its grace
+        period"""
+        age = (datetime.utcnow() - channel.created_at).total_seconds()
+        self._arm(server_id, channel.id, GRACE_PERIOD - age)
+
+    async def _deletion_loop(self):
+        await self.bot.wait_until_ready()
+        for server_id in list(self.settings):
+            server = self.bot.get_server(server_id)
+            if server is not None:
+                self.reconcile_occupancy(server)
+
+        while True:
+            self._wakeup.clear()
+            deadlines = self._deadlines
+            while deadlines and \
+                    self._armed.get(deadlines[0][1]) != deadlines[0][0]:
+                heapq.heappop(deadlines)  # cancelled or re-armed since
+            if not deadlines:
+                await self._wakeup.wait()
+                continue
+            delay = deadlines[0][0] - self.bot.loop.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            when, channel_id, server_id = heapq.heappop(deadlines)
+            del self._armed[channel_id]
+            try:
+                await self._expire(server_id, channel_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Error deleting temp channel {}"
+                              "".format(channel_id))
+
+    async def _expire(self, server_id, channel_id):
+        """deletes a temp channel whose timer ran out if it's still empty"""
+        if server_id not in self.settings:
+            return
+        channels = self.settings[server_id]['channels']
+        cache = self.settings[server_id]['cache']
+        server = self.bot.get_server(server_id)
+        channel = server.get_channel(channel_id) \
+            if server is not None else None
+        if channel is not None:
+            if self.occupancy.get(channel_id, 0) > 0:
+                return
+            with self.latency.time(server_id, 'delete'):
+                await self.bot.delete_channel(channel)
+        self.occupancy.pop(channel_id, None)
+        if channel_id in channels:
+            channels.remove(channel_id)
+        if channel_id in cache:
+            cache.remove(channel_id)
+        self.save_json(server_id)
 
     @commands.group(name="tempchannels", aliases=["tmpc"],
                     pass_context=True, no_pm=True)
@@ -43,7 +262,7 @@ class TempChannels:
                                         'channels': [],
                                         'cache': []
                                         }
-            self.save_json()
+            self.save_json(server_id)
 
     @checks.admin_or_permissions(Manage_channels=True)
     @tempset.command(name="toggleactive", pass_context=True, no_pm=True)
@@ -57,12 +276,12 @@ class TempChannels:
 
         if self.settings[server.id]['toggleactive'] is True:
             self.settings[server.id]['toggleactive'] = False
-            self.save_json()
+            self.save_json(server.id)
             await self.bot.say('Creation of temporary '
                                'channels is now disabled.')
         else:
             self.settings[server.id]['toggleactive'] = True
-            self.save_json()
+            self.save_json(server.id)
             await self.bot.say('Creation of temporary '
                                'channels is now enabled.')
 
@@ -78,14 +297,32 @@ class TempChannels:
 
         if self.settings[server.id]['toggleowner'] is True:
             self.settings[server.id]['toggleowner'] = False
-            self.save_json()
+            self.save_json(server.id)
             await self.bot.say('Users no longer own the temp '
                                'channels they make.')
         else:
             self.settings[server.id]['toggleowner'] = True
-            self.save_json()
+            self.save_json(server.id)
             await self.bot.say('Users now own the temp channels they make.')
 
+    @tempchannels.command(name="stats", pass_context=True, no_pm=True)
+    async def tempstats(self, ctx):
+        """shows how this server's temp channels are being used"""
+        server = ctx.message.server
+        if server.id not in self.settings:
+            return await self.bot.say('No Entires for this server.')
+
+        channel_ids = self.settings[server.id]['channels']
+        counts = [self.occupancy.get(c, 0) for c in channel_ids]
+        pending = sum(1 for c in channel_ids if c in self._armed)
+        await self.bot.say(box("Temp channels: {}\n"
+                               "In use: {}\n"
+                               "Connected members: {}\n"
+                               "Waiting for deletion: {}"
+                               "".format(len(channel_ids),
+                                         sum(1 for n in counts if n),
+                                         sum(counts), pending)))
+
     @tempchannels.command(name="new", pass_context=True, no_pm=True)
     async def newtemp(self, ctx, *, name):
         """makes a new temporary channel"""
@@ -103,16 +340,20 @@ class TempChannels:
         elif self.settings[server.id]['toggleactive'] is False:
             await self.bot.say('This command is currently turned off.')
         else:
-            channel = await self.bot.create_channel(
+            with self.latency.time(server.id, 'create'):
+                channel = await self.bot.create_channel(
                                  server, cname, type=discord.ChannelType.voice)
             if self.settings[server.id]['toggleowner'] is True:
                 overwrite = discord.PermissionOverwrite()
                 overwrite.manage_channels = True
                 overwrite.manage_roles = True
-                await self.bot.edit_channel_permissions(
+                with self.latency.time(server.id, 'permissions'):
+                    await self.bot.edit_channel_permissions(
                                         channel, ctx.message.author, overwrite)
             self.settings[server.id]['channels'].append(channel.id)
-            self.save_json()
+            self.save_json(server.id)
+            self.occupancy[channel.id] = 0
+            self._arm(server.id, channel.id, GRACE_PERIOD)
 
     @checks.admin_or_permissions(Manage_server=True)
     @tempchannels.command(name="purge", hidden=True,
@@ -121,92 +362,151 @@ class TempChannels:
         """purges this server's temp channels even if in use"""
         server = ctx.message.server
 
-        if server.id in self.settings:
-            channels = self.settings[server.id]['channels']
-            for channel_id in channels:
-                channel = server.get_channel(channel_id)
-                if channel is not None:
-                    await asyncio.sleep(1)
+        if server.id not in self.settings:
+            return await self.bot.say('No Entires for this server.')
+
+        channels = self.settings[server.id]['channels']
+        targets = [server.get_channel(c) for c in channels]
+        targets = [c for c in targets if c is not None]
+        total = len(targets)
+        status = await self.bot.say('Purging {} temporary channels...'
+                                    ''.format(total))
+        semaphore = asyncio.Semaphore(PURGE_CONCURRENCY)
+
+        async def delete(channel):
+            async with semaphore:
+                try:
                     await self.bot.delete_channel(channel)
-                    channels.remove(channel.id)
-                    self.save_json()
-                await asyncio.sleep(1)
-            await self.bot.say('Temporary Channels Purged')
-        else:
-            await self.bot.say('No Entires for this server.')
+                except discord.NotFound:
+                    pass
+                except discord.HTTPException:
+                    return channel, False
+            return channel, True
+
+        deleted = set()
+        failed = 0
+        last_update = time.perf_counter()
+        for future in asyncio.as_completed([delete(c) for c in targets]):
+            channel, ok = await future
+            if ok:
+                deleted.add(channel.id)
+                self._disarm(channel.id)
+                self.occupancy.pop(channel.id, None)
+            else:
+                failed += 1
+            now = time.perf_counter()
+            if now - last_update >= PURGE_PROGRESS_INTERVAL:
+                last_update = now
+                try:
+                    await self.bot.edit_message(
+                        status, 'Purging temporary channels... {}/{}'
+                                ''.format(len(deleted) + failed, total))
+                except discord.HTTPException:
+                    pass
+
+        channels[:] = [c for c in channels if c not in deleted]
         self.settingscleanup(server)
+        result = 'Temporary Channels Purged ({} deleted)'.format(len(deleted))
+        if failed:
+            result += ', {} could not be deleted'.format(failed)
+        try:
+            await self.bot.edit_message(status, result)
+        except discord.HTTPException:
+            await self.bot.say(result)
+
+    def save_json(self, server_id):
+        """
+        marks a server's settings as changed, changes are written on a
+        short delay so each server's file is written at most once for a
+        burst of changes
+        """
+        self._dirty.add(server_id)
+        if self._flush_handle is None:
+            self._flush_handle = self.bot.loop.call_later(FLUSH_DELAY,
+                                                          self.flush)
 
-    def save_json(self):
-        dataIO.save_json("data/tempchannels/settings.json", self.settings)
+    def flush(self):
+        """writes the settings of every server with pending changes"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        while self._dirty:
+            server_id = self._dirty.pop()
+            if server_id not in self.settings:
+                continue
+            with self.latency.time(server_id, 'save'):
+                dataIO.save_json(self._shard_path(server_id),
+                                 self.settings[server_id])
+
+    @checks.is_owner()
+    @tempset.command(name="timings", pass_context=True, hidden=True)
+    async def timings(self, ctx, server_id: str=None):
+        """
+        shows p50/p95/p99 timings of each stage of handling voice events
+        for every server, or just the one given
+        """
+        if server_id is not None:
+            server_ids = [server_id]
+        else:
+            server_ids = sorted(self.latency.events,
+                                key=lambda s: self.latency.events[s],
+                                reverse=True)
+        if not server_ids:
+            return await self.bot.say("No voice events handled yet.")
+        output = "\n".join(self.latency.summary(s) for s in server_ids)
+        for page in pagify(output, delims=["\nServer", "\n"]):
+            await self.bot.say(box(page))
 
     async def autoempty(self, memb_before, memb_after):
         """This cog is Self Cleaning"""
         server = memb_after.server
-        if server.id not in self.settings:
-            self.initial_config(server.id)
-        channels = self.settings[server.id]['channels']
-        cache = self.settings[server.id]['cache']
+        b_server = memb_before.server
+        start = time.perf_counter()
+        self.latency.count(server.id)
 
-        if memb_after.voice.voice_channel is not None:
-            channel = memb_after.voice.voice_channel
-            if channel.id in channels:
-                if channel.id not in cache:
-                    cache.append(channel.id)
-                    self.save_json()
-
-        if memb_before.server == memb_after.server:
-            channel = memb_before.voice.voice_channel
-            if channel is not None:
-                if channel.id in cache:
-                    if len(channel.voice_members) == 0:
-                        await self.bot.delete_channel(channel)
-                        cache.remove(channel.id)
-                        channels.remove(channel.id)
-                        self.save_json()
-        else:
-            channel = memb_before.voice.voice_channel
-            if channel is not None:
-                b4cache = self.settings[memb_before.server.id]['cache']
-                if channel.id in b4cache:
-                    if len(channel.voice_members) == 0:
-                        await self.bot.delete_channel(channel)
-                        cache.remove(channel.id)
-                        channels.remove(channel.id)
-                        self.save_json()
-
-        for channel_id in channels:
-            channel = server.get_channel(channel_id)
-            if channel is not None:
-                if len(server.get_channel(channel_id).voice_members) == 0:
-                    tnow = datetime.utcnow()
-                    ctime = server.get_channel(channel_id).created_at
-                    tdelta = tnow - ctime
-                    if tdelta.seconds > 300:
-                        await self.bot.delete_channel(channel)
-                        channels.remove(channel.id)
-                        self.save_json()
-                        await asyncio.sleep(1)
+        with self.latency.time(server.id, 'config'):
+            if server.id not in self.settings:
+                self.initial_config(server.id)
+            channels = self.settings[server.id]['channels']
+            cache = self.settings[server.id]['cache']
 
-        self.settingscleanup(server)
+        before = memb_before.voice.voice_channel
+        after = memb_after.voice.voice_channel
+        if before == after:
+            # mute, deafen and the like
+            before = after = None
+
+        if after is not None and after.id in channels:
+            self.occupancy[after.id] = self.occupancy.get(after.id, 0) + 1
+            self._disarm(after.id)
+            if after.id not in cache:
+                cache.append(after.id)
+                self.save_json(server.id)
+
+        if before is not None and before.id in self.occupancy:
+            count = max(self.occupancy[before.id] - 1, 0)
+            self.occupancy[before.id] = count
+            if b_server.id in self.settings and count == 0:
+                if before.id in self.settings[b_server.id]['cache']:
+                    self._arm(b_server.id, before.id)
+
+        self.latency.record(server.id, 'total',
+                            (time.perf_counter() - start) * 1000)
 
     def settingscleanup(self, server):
         """cleanup of settings"""
         if server.id in self.settings:
             channels = self.settings[server.id]['channels']
             cache = self.settings[server.id]['cache']
-            for channel_id in channels:
-                channel = server.get_channel(channel_id)
-                if channel is None:
-                    channels.remove(channel_id)
-                    self.save_json()
-            for channel_id in cache:
-                if channel_id not in channels:
-                    cache.remove(channel_id)
-                    self.save_json()
+            channels[:] = [c for c in channels
+                           if server.get_channel(c) is not None]
+            remaining = set(channels)
+            cache[:] = [c for c in cache if c in remaining]
+            self.save_json(server.id)
 
 
 def check_folder():
-    f = 'data/tempchannels'
+    f = SHARD_DIR
     if not os.path.exists(f):
         os.makedirs(f)
 
@@ -2,8 +2,11 @@ import discord
 from discord.ext import commands
 from cogs.utils import checks
 from cogs.utils.dataIO import dataIO
+from cogs.utils.chat_formatting import pagify
 import logging
 import os
+import time
+import heapq
 import asyncio
 from datetime import datetime, timedelta
 assert asyncio  # shakes fist at linter
@@ -11,6 +14,17 @@ assert asyncio  # shakes fist at linter
 
 log = logging.getLogger("red.TempText")
 
+# channels due within this many seconds of each other are deleted together
+EXPIRY_WINDOW = 5
+# deletions in flight at once
+DELETE_CONCURRENCY = 5
+# seconds before trying again when a channel couldn't be deleted
+RETRY_DELAY = 600
+# most channels one bulk command can make, and how many requests it
+# keeps in flight at once
+BULK_LIMIT = 50
+BULK_CONCURRENCY = 5
+
 creationmessage = "Hi {0.mention}, I've created your channel here. " \
                   "People eligible to join can do so by using the following " \
                   "command.\n`{1}jointxt {2.id}`"  # author, prefix, channel
@@ -36,7 +50,19 @@ class TempText:
                                                        send_messages=True,
                                                        manage_channels=True,
                                                        manage_roles=True)
-        self._load()
+        # channel expiry, a heap of (expiry timestamp, channel id)
+        # entries only count if they still match channels.json
+        self._deadlines = []
+        self._wakeup = asyncio.Event()
+        # resolved objects by id, dropped when discord says they're gone
+        self._channel_cache = {}
+        self._role_cache = {}
+        # channels _temp_deletion is deleting, it saves for those itself
+        self._deleting = set()
+        self._expiry_task = self.bot.loop.create_task(self._expiry_loop())
+
+    def __unload(self):
+        self._expiry_task.cancel()
 
     def update_settings(self, server: discord.Server, data=None):
         if server.id not in self.settings:
@@ -57,25 +83,79 @@ class TempText:
         dataIO.save_json("data/temptext/channels.json", self.channels)
 
     def _load(self):
-        now = datetime.utcnow()
-        channel_ids = [c.id for c in self.bot.get_all_channels()]
-        self.channels = {k: v for k, v in self.channels.items()
-                         if v['id'] in channel_ids}
-        valid_chans = [c for c in self.bot.get_all_channels()
-                       if c.id in self.channels.keys()]
-        for channel in valid_chans:
-
-            if channel.created_at + \
-                timedelta(seconds=self.channels[channel.id]['lifetime']) > \
-                    now:
-                sec = 0
+        """
+        matches channels.json up with the channels that still exist and
+        schedules them, this needs the client cache so only runs once the
+        bot is ready. Returns counts of channels restored, already
+        expired, and forgotten because they no longer exist
+        """
+        now = time.time()
+        restored = expired = forgotten = 0
+        for channel_id, data in list(self.channels.items()):
+            server = self.bot.get_server(data['server'])
+            if server is None or server.get_channel(channel_id) is None:
+                del self.channels[channel_id]
+                forgotten += 1
+                continue
+            if 'expires' not in data:
+                # entries from before expiry times were stored
+                created = discord.utils.snowflake_time(channel_id)
+                expires = created + timedelta(seconds=data['lifetime'])
+                data['expires'] = \
+                    (expires - datetime(1970, 1, 1)).total_seconds()
+            if data['expires'] <= now:
+                expired += 1
             else:
-                sec = (channel.created_at +
-                       timedelta(seconds=self.channels[channel.id]['lifetime'])
-                       - nowdelete_in).seconds
-
-            coro = self._temp_deletion(channel.id)
-            self.bot.loop.call_later(sec, self.bot.loop.create_task, coro)
+                restored += 1
+            self._schedule(channel_id)
+        if forgotten:
+            self.save_channels()
+        return restored, expired, forgotten
+
+    def _schedule(self, chan_id):
+        """queues a channel for deletion at its stored expiry time"""
+        expires = self.channels[chan_id]['expires']
+        heapq.heappush(self._deadlines, (expires, chan_id))
+        if self._deadlines[0][1] == chan_id:
+            self._wakeup.set()
+
+    async def _expiry_loop(self):
+        """
+        sleeps until the next channel is due and deletes it, anything that
+        came due while the bot was down is handled as soon as it's ready
+        """
+        await self.bot.wait_until_ready()
+        log.info("Temp text channels restored: {}, expired: {}, "
+                 "forgotten: {}".format(*self._load()))
+        deadlines = self._deadlines
+        while True:
+            self._wakeup.clear()
+            while deadlines and \
+                    self.channels.get(deadlines[0][1], {}).get('expires') \
+                    != deadlines[0][0]:
+                heapq.heappop(deadlines)  # already gone
+            if not deadlines:
+                await self._wakeup.wait()
+                continue
+            delay = deadlines[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            due = []
+            cutoff = time.time() + EXPIRY_WINDOW
+            while deadlines and deadlines[0][0] <= cutoff:
+                expires, chan_id = heapq.heappop(deadlines)
+                if self.channels.get(chan_id, {}).get('expires') == expires:
+                    due.append(chan_id)
+            try:
+                await self._temp_deletion(*due)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.debug("{}".format(e))
 
     @checks.admin_or_permissions(manage_server=True)
     @commands.group(name="tmptxtset", pass_context=True, no_pm=True)
@@ -160,6 +240,84 @@ class TempText:
         self.update_settings(ctx.message.server, {'rid': rid})
         await self.bot.say("Settings updated.")
 
+    @tmptxtset.command(name="bulk", pass_context=True, no_pm=True)
+    async def bulk_add(self, ctx, *args):
+        """
+        makes several temp channels at once, all with the same lifetime
+        and required role
+        takes time in mintes(m), hours (h), days (d) and optionally a role
+        to require for joining in the format key=value, followed by the
+        channel names
+        example: [p]tmptxtset bulk h=2 role=Players team-1 team-2 team-3
+        Lifetime defaults to the server's default if not provided
+        """
+        server = ctx.message.server
+        author = ctx.message.author
+        if server.id not in self.settings:
+            self.update_settings(server)
+
+        timevalues = {}
+        role = None
+        names = []
+        for arg in args:
+            key, sep, value = arg.partition('=')
+            if sep and key in ('d', 'h', 'm') and value.isdigit():
+                timevalues[key] = int(value)
+            elif sep and key == 'role':
+                role = discord.utils.find(
+                    lambda r: value in (r.id, r.name, r.mention),
+                    server.roles)
+                if role is None:
+                    return await self.bot.say("I couldn't find that role")
+            else:
+                names.append(arg)
+
+        if not names:
+            return await self.bot.send_cmd_help(ctx)
+        if len(names) > BULK_LIMIT:
+            return await self.bot.say("I can only make {} channels at once"
+                                      "".format(BULK_LIMIT))
+        if timevalues:
+            seconds = self._parse_time(timevalues)
+        else:
+            seconds = self.settings[server.id]['default_time']
+        if not self._is_valid_interval(seconds):
+            return await self.bot.say("That wasn't a valid time")
+
+        role_id = role.id if role is not None else None
+        semaphore = asyncio.Semaphore(BULK_CONCURRENCY)
+
+        async def make(name):
+            async with semaphore:
+                try:
+                    x = await self._create_temp(author, name, seconds,
+                                                role_id)
+                except discord.HTTPException as e:
+                    log.debug("{}".format(e))
+                    return None
+                try:
+                    await self.bot.send_message(
+                        x, creationmessage.format(author, ctx.prefix, x))
+                except discord.HTTPException as e:
+                    log.debug("{}".format(e))
+            return x
+
+        start = time.perf_counter()
+        made = await asyncio.gather(*[make(n) for n in names])
+        elapsed = time.perf_counter() - start
+        made = [x for x in made if x is not None]
+        self.save_channels()
+        for x in made:
+            self._schedule(x.id)
+
+        output = "Made {} of {} channels in {:.1f}s ({:.0f}ms per channel)" \
+            "".format(len(made), len(names), elapsed,
+                      elapsed * 1000 / len(names))
+        if made:
+            output += "\n" + " ".join(x.mention for x in made)
+        for page in pagify(output, delims=["\n", " "]):
+            await self.bot.say(page)
+
     @commands.command(pass_context=True, no_pm=True, name="jointxt")
     async def _join_text(self, ctx, chan_id: str):
         """try to join a room"""
@@ -168,9 +326,8 @@ class TempText:
             await self.bot.delete_message(ctx.message)
         except Exception:
             pass
-        c = discord.utils.get(self.bot.get_all_channels(), id=chan_id,
-                              server__id=author.server.id)
-        if chan_id not in self.channels or c is None:
+        c = self._get_channel(chan_id)
+        if c is None or c.server.id != author.server.id:
             return await self.bot.say("That isn't a joinable channel")
         if not self._is_allowed(author, chan_id):
             return await self.bot.say("Sorry, you can't join that room")
@@ -231,15 +388,8 @@ class TempText:
             return
 
         try:
-            author_perms = self.owner_perms \
-                if self.settings[server.id]['author_is_owner'] \
-                else self.joined_perms
-            x = await self.bot.create_channel(server, channel_name,
-                                              (server.default_role,
-                                               self.everyone_perms),
-                                              (author, author_perms),
-                                              (server.me, self.joined_perms)
-                                              )
+            x = await self._create_temp(author, channel_name, seconds,
+                                        role_id)
         except discord.Forbidden:
             raise TmpTxtError("I literally can't even")
             return
@@ -248,41 +398,110 @@ class TempText:
             raise TmpTxtError("Something unexpected happened. Try again later")
             return
 
+        self.save_channels()
+        self._schedule(x.id)
+        await self.bot.send_message(x, creationmessage.format(author, prefix,
+                                                              x))
+        return x
+
+    async def _create_temp(self, author: discord.Member, channel_name,
+                           seconds, role_id=None):
+        """makes a temp channel and tracks it, without saving"""
+        server = author.server
+        author_perms = self.owner_perms \
+            if self.settings[server.id]['author_is_owner'] \
+            else self.joined_perms
+        x = await self.bot.create_channel(server, channel_name,
+                                          (server.default_role,
+                                           self.everyone_perms),
+                                          (author, author_perms),
+                                          (server.me, self.joined_perms)
+                                          )
         self.channels[x.id] = {'id': x.id,
                                'rid': role_id,
                                'lifetime': seconds,
+                               'expires': time.time() + seconds,
                                'owner': author.id,
                                'server': server.id}
-        self.save_channels()
-
-        self._scheduling_things_sucks(x.id, seconds)
-        await self.bot.send_message(x, creationmessage.format(author, prefix,
-                                                              x))
+        self._channel_cache[x.id] = x
         return x
 
-    def _scheduling_things_sucks(self, chan_id, seconds):
-        coro = self._temp_deletion(chan_id)
-        self.bot.loop.call_later(seconds, self.bot.loop.create_task, coro)
+    def _get_channel(self, chan_id):
+        """looks up a temp channel by id"""
+        data = self.channels.get(chan_id)
+        if data is None:
+            return None
+        channel = self._channel_cache.get(chan_id)
+        if channel is None:
+            server = self.bot.get_server(data['server'])
+            if server is None:
+                return None
+            channel = server.get_channel(chan_id)
+            if channel is not None:
+                self._channel_cache[chan_id] = channel
+        return channel
+
+    def _get_role(self, server: discord.Server, role_id: str):
+        role = self._role_cache.get(role_id)
+        if role is None:
+            role = discord.utils.get(server.roles, id=role_id)
+            if role is not None:
+                self._role_cache[role_id] = role
+        return role
+
+    async def _channel_deleted(self, channel):
+        if channel.id in self._deleting:
+            return
+        self._channel_cache.pop(channel.id, None)
+        if self.channels.pop(channel.id, None) is not None:
+            self.save_channels()
 
-    async def _temp_deletion(self, *channel_ids: str):
+    async def _role_deleted(self, role):
+        self._role_cache.pop(role.id, None)
 
-        channels = [c for c in self.bot.get_all_channels()
-                    if c.id in channel_ids]
+    async def _server_removed(self, server):
+        for cache in (self._channel_cache, self._role_cache):
+            for k in [k for k, v in cache.items() if v.server.id == server.id]:
+                del cache[k]
 
-        disappeared = [cid for cid in channel_ids
-                       if cid not in [c.id for c in channels]]
-        self.channels = \
-            {k: v for k, v in self.channels.items()
-             if v['id'] not in disappeared}
+    async def _temp_deletion(self, *channel_ids: str):
+        semaphore = asyncio.Semaphore(DELETE_CONCURRENCY)
+
+        async def delete(channel):
+            async with semaphore:
+                try:
+                    await self.bot.delete_channel(channel)
+                except discord.NotFound:
+                    pass
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    log.debug("{}".format(e))
+                    return False
+            return True
 
-        for channel in channels:
-            try:
-                cid = channel.id
-                await self.bot.delete_channel(channel)
-            except Exception as e:
-                log.debug("{}".format(e))
+        channels = []
+        for cid in channel_ids:
+            channel = self._get_channel(cid)
+            if channel is None:
+                self.channels.pop(cid, None)  # disappeared
             else:
-                self.channels.pop(cid, None)
+                channels.append(channel)
+
+        ids = set(c.id for c in channels)
+        self._deleting.update(ids)
+        try:
+            results = await asyncio.gather(*[delete(c) for c in channels])
+        finally:
+            self._deleting.difference_update(ids)
+        for channel, deleted in zip(channels, results):
+            if deleted:
+                self.channels.pop(channel.id, None)
+                self._channel_cache.pop(channel.id, None)
+            elif channel.id in self.channels:
+                self.channels[channel.id]['expires'] = \
+                    time.time() + RETRY_DELAY
+                self._schedule(channel.id)
 
         self.save_channels()
 
@@ -292,26 +511,29 @@ class TempText:
             return False
         if not self.settings[server.id].get('active', False):
             return False
+        # a required role that has since been deleted can't be met
         if chan_id is not None:
             rid = self.channels[chan_id].get('rid', None)
             if rid is not None:
-                role = [r for r in server.roles if r.id == rid][0]
-                if role not in author.roles:
+                role = self._get_role(server, rid)
+                if role is None or role not in author.roles:
                     return False
         else:
             rid = self.settings[server.id].get('rid', None)
             if rid is not None:
-                role = [r for r in server.roles if r.id == rid][0]
+                role = self._get_role(server, rid)
+                if role is None:
+                    return False
                 if self.settings[server.id].get('strict', True):
                     return role in author.roles
                 else:
                     return author.top_role >= role
         return True
 
-    def _parse_time(**kwargs):
-        return ((kwargs.pop('d', 0) * 24
-                 + kwargs.pop('h', 0)) * 60
-                + kwargs.pop('m', 0)) * 60
+    def _parse_time(self, timevalues):
+        return ((int(timevalues.get('d', 0)) * 24
+                 + int(timevalues.get('h', 0))) * 60
+                + int(timevalues.get('m', 0))) * 60
 
     def _is_valid_interval(self, seconds: int):
         return 600 <= seconds <= 172800  # 10m <= seconds <= 2d
@@ -336,4 +558,7 @@ def setup(bot):
     check_folder()
     check_files()
     n = TempText(bot)
+    bot.add_listener(n._channel_deleted, "on_channel_delete")
+    bot.add_listener(n._role_deleted, "on_server_role_delete")
+    bot.add_listener(n._server_removed, "on_server_remove")
     bot.add_cog(n)